@@ -0,0 +1,342 @@
+"""
+Micro-benchmarks for netplay.packer.  Doesn't need bge, run it with any
+Python 3:
+
+    python benchmark.py
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+
+The core cases only use what packer has always had, so results saved on
+older versions compare with newer ones.  Cases for newer features are
+skipped when the packer being measured doesn't have them.
+
+For every case it reports:
+- ops/sec: best of several timed runs
+- bytes/op: size of the buffer produced or consumed
+- peak/op: most memory held at once during one op, temporaries
+  included, from tracemalloc
+- kept/op: memory blocks still held per op when the results are kept,
+  which is roughly what a result costs the allocator
+"""
+import argparse
+import gc
+import inspect
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+from netplay import packer
+
+
+def get_features():
+    # What the packer being measured supports
+    to_table_args = inspect.signature(packer.to_table).parameters
+    features = {
+        'lazy': 'lazy' in to_table_args,
+        'pooled': 'pooled' in to_table_args,
+        'writer': hasattr(packer, 'PacketWriter'),
+        'compact': False,
+        'quantized': False,
+    }
+
+    if features['writer']:
+        writer_args = inspect.signature(packer.PacketWriter).parameters
+        features['compact'] = 'compact' in writer_args
+
+    return features
+
+
+def define_tables(features):
+    tabledef = packer.TableDef('BenchSmall')
+    tabledef.define('uint16', 'id')
+    tabledef.define('uint8', 'input', 0)
+    tabledef.define('float', 'x', 0.0)
+
+    # Fields a player state would have, as plain numbers
+    tabledef = packer.TableDef('BenchMedium')
+    tabledef.define('uint16', 'id')
+    for axis in 'xyz':
+        tabledef.define('float', 'pos_' + axis, 0.0)
+        tabledef.define('float', 'vel_' + axis, 0.0)
+    for axis in 'wxyz':
+        tabledef.define('float', 'rot_' + axis, 0.0)
+    tabledef.define('uint8', 'input', 0)
+    tabledef.define('float', 'pitch', 0.0)
+    tabledef.define('float', 'yaw', 0.0)
+    tabledef.define('float', 'health', 100.0)
+    tabledef.define('int32', 'score', 0)
+    tabledef.define('float', 'speed', 6.0)
+    tabledef.define('double', 'time', 0.0)
+
+    tabledef = packer.TableDef('BenchWide')
+    tabledef.define('uint16', 'id')
+    for i in range(64):
+        tabledef.define('float', 'f{:02}'.format(i), float(i))
+
+    tabledef = packer.TableDef('BenchJson')
+    tabledef.define('uint16', 'id')
+    tabledef.define('json', 'messages')
+    tabledef.define('json', 'name')
+
+    # The same player state with quantized fields
+    tabledef = packer.TableDef('BenchQuantized')
+    try:
+        tabledef.define('uint16', 'id')
+        tabledef.define('transform', 'transform', velocity=True)
+        tabledef.define('uint8', 'input', 0)
+        tabledef.define('angle16', 'pitch', 0.0)
+        tabledef.define('angle16', 'yaw', 0.0)
+        tabledef.define('fixed16', 'health', 100.0, min=0.0, max=100.0)
+        tabledef.define('int32', 'score', 0)
+        tabledef.define('float', 'speed', 6.0)
+        tabledef.define('double', 'time', 0.0)
+    except (KeyError, TypeError):
+        pass
+    else:
+        features['quantized'] = True
+
+
+def make_table(name, net_id=1):
+    table = packer.Table(name)
+    table['id'] = net_id
+
+    if name == 'BenchMedium':
+        for axis, value in zip('xyz', (1.0, 2.0, 3.0)):
+            table['pos_' + axis] = value
+        table['vel_z'] = -9.8
+        for axis in 'wxyz':
+            table['rot_' + axis] = 0.5
+    elif name == 'BenchQuantized':
+        table['transform'] = ((1.0, 2.0, 3.0), (0.5, 0.5, 0.5, 0.5),
+                              (0.0, 0.0, -9.8), (0.0, 0.0, 0.0))
+    elif name == 'BenchJson':
+        table['messages'] = ['{}: message number {}'.format(i % 4, i)
+                             for i in range(12)]
+        table['name'] = 'unnamed'
+
+    return table
+
+
+def measure(func, min_time):
+    # Finds a loop count that takes at least min_time, best of 3 runs
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+
+    best = elapsed
+    for i in range(2):
+        start = time.perf_counter()
+        for i in range(number):
+            func()
+        best = min(best, time.perf_counter() - start)
+
+    return number / best
+
+
+def measure_peak(func, number=5):
+    # Smallest tracemalloc peak over a few single ops, in bytes
+    func()
+    best = None
+    for i in range(number):
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        if best is None or peak < best:
+            best = peak
+
+    return best
+
+
+def count_kept(func, number=1000):
+    results = [None] * number
+    gc.collect()
+    gc.disable()
+    try:
+        before = sys.getallocatedblocks()
+        for i in range(number):
+            results[i] = func()
+        after = sys.getallocatedblocks()
+    finally:
+        gc.enable()
+
+    return (after - before) / number
+
+
+def run_case(name, func, size, min_time):
+    result = {
+        'ops_per_sec': measure(func, min_time),
+        'bytes_per_op': size,
+        'peak_bytes_per_op': measure_peak(func),
+        'kept_blocks_per_op': count_kept(func),
+    }
+    print('{:<32} {:>14,.0f} ops/sec {:>8} bytes/op {:>8} peak/op '
+          '{:>6.1f} kept/op'.format(
+              name, result['ops_per_sec'], size,
+              result['peak_bytes_per_op'], result['kept_blocks_per_op']))
+    return result
+
+
+def run(min_time):
+    features = get_features()
+    define_tables(features)
+    results = {}
+
+    names = ['BenchSmall', 'BenchMedium', 'BenchWide', 'BenchJson']
+    if features['quantized']:
+        names.append('BenchQuantized')
+
+    for name in names:
+        table = make_table(name)
+        buff = packer.to_bytes(table)
+        size = len(buff)
+
+        results['to_bytes/' + name] = run_case(
+            'to_bytes/' + name, lambda: packer.to_bytes(table), size,
+            min_time)
+
+        results['to_table/' + name] = run_case(
+            'to_table/' + name, lambda: packer.to_table(buff), size,
+            min_time)
+
+        if features['lazy']:
+            results['to_table_lazy/' + name] = run_case(
+                'to_table_lazy/' + name,
+                lambda: packer.to_table(buff, lazy=True).get('id'), size,
+                min_time)
+
+        if features['pooled']:
+            def pooled():
+                table = packer.to_table(buff, lazy=True, pooled=True)
+                net_id = table.get('id')
+                packer.release(table)
+                return net_id
+
+            results['to_table_pooled/' + name] = run_case(
+                'to_table_pooled/' + name, pooled, size, min_time)
+
+    for count in (1, 10, 100, 1000):
+        bufflist = [packer.to_bytes(make_table('BenchMedium', i))
+                    for i in range(count)]
+        joined = packer.join_buffers(bufflist)
+        tables = [make_table('BenchMedium', i) for i in range(count)]
+
+        name = 'join_buffers/{}'.format(count)
+        results[name] = run_case(
+            name, lambda: packer.join_buffers(bufflist), len(joined),
+            min_time)
+
+        if features['writer']:
+            writer = packer.PacketWriter()
+
+            def write_tables():
+                writer.clear()
+                for table in tables:
+                    writer.write_table(table)
+                return bytes(writer.finish())
+
+            name = 'PacketWriter.write_table/{}'.format(count)
+            results[name] = run_case(name, write_tables, len(joined),
+                                     min_time)
+
+        if features['compact']:
+            compact = packer.PacketWriter(compact=True)
+
+            def write_compact():
+                compact.clear()
+                for table in tables:
+                    compact.write_table(table)
+                return bytes(compact.finish())
+
+            compact_joined = write_compact()
+            name = 'PacketWriter.compact/{}'.format(count)
+            results[name] = run_case(name, write_compact,
+                                     len(compact_joined), min_time)
+
+            name = 'unjoin_buffers.compact/{}'.format(count)
+            results[name] = run_case(
+                name, lambda: packer.unjoin_buffers(compact_joined),
+                len(compact_joined), min_time)
+
+            name = 'unjoin+to_table.compact/{}'.format(count)
+            results[name] = run_case(
+                name, lambda: [packer.to_table(b) for b in
+                               packer.unjoin_buffers(compact_joined)],
+                len(compact_joined), min_time)
+
+        name = 'unjoin_buffers/{}'.format(count)
+        results[name] = run_case(
+            name, lambda: packer.unjoin_buffers(joined), len(joined),
+            min_time)
+
+        name = 'unjoin+to_table/{}'.format(count)
+        results[name] = run_case(
+            name, lambda: [packer.to_table(b)
+                           for b in packer.unjoin_buffers(joined)],
+            len(joined), min_time)
+
+    return results
+
+
+def compare(results, path):
+    with open(path) as f:
+        previous = json.load(f)['results']
+
+    print('')
+    print('Compared to {}'.format(path))
+    for name, result in sorted(results.items()):
+        old = previous.get(name, None)
+        if old is None:
+            continue
+
+        # Files from before peak/op was measured only have the rest
+        line = '{:<32} {:>6.2f}x ops/sec {:>+8} bytes/op'.format(
+            name, result['ops_per_sec'] / old['ops_per_sec'],
+            result['bytes_per_op'] - old['bytes_per_op'])
+        if 'peak_bytes_per_op' in old:
+            line += ' {:>+8} peak/op {:>+6.1f} kept/op'.format(
+                result['peak_bytes_per_op'] - old['peak_bytes_per_op'],
+                result['kept_blocks_per_op'] - old['kept_blocks_per_op'])
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--output', help='Save results as JSON')
+    parser.add_argument('--compare', help='Results JSON from an earlier run')
+    parser.add_argument('--label', default='', help='Stored with the results')
+    parser.add_argument('--quick', action='store_true',
+                        help='Shorter runs, less accurate')
+    args = parser.parse_args()
+
+    min_time = 0.05 if args.quick else 0.2
+    results = run(min_time)
+
+    if args.compare:
+        compare(results, args.compare)
+
+    if args.output:
+        data = {
+            'label': args.label,
+            'time': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,22 +8,22 @@ import logging
 def define_tables():
     tabledef = packer.TableDef('ChatSetup')
     tabledef.define('uint16', 'id')
-    # One limitation with tables is that you can only have 1 json definition
-    # But that's OK because it can be a container
+    # json works for anything that doesn't fit the other types
     tabledef.define('json', 'messages')
     tabledef.component = ChatWindow
 
     tabledef = packer.TableDef('MessageToServer')
     tabledef.define('uint16', 'id')
-    tabledef.define('json', 'message')
+    tabledef.define('str', 'message')
 
     tabledef = packer.TableDef('MessageToClient')
     tabledef.define('uint16', 'id')
-    tabledef.define('json', 'fullmessage')
+    tabledef.define('str', 'fullmessage')
 
 
 class ChatWindow(component.GameObject):
     obj = None
+    always_relevant = True
 
     def start(self):
         None
@@ -1,5 +1,4 @@
 import bge
-import mathutils
 from netplay import packer, component
 
 
@@ -16,63 +15,39 @@ def define_tables():
         bge.logic.getCurrentScene().objects['Empty'].state = 2
 
 
-class Cube(component.GameObject):
+class Cube(component.RigidGameObject):
     obj = 'Cube'
 
     def serialize(self):
+        return packer.to_bytes(self.get_state())
+
+    def get_state(self):
         owner = self.owner
         table = packer.Table('CubeSetup')
         table['id'] = self.net_id
 
-        pos = owner.worldPosition
-        table['pos_x'] = pos[0]
-        table['pos_y'] = pos[1]
-        table['pos_z'] = pos[2]
-
-        rot = owner.worldOrientation.to_quaternion()
-        table['rot_x'] = rot[0]
-        table['rot_y'] = rot[1]
-        table['rot_z'] = rot[2]
-        table['rot_w'] = rot[3]
-
-        lv = owner.getLinearVelocity(False)
-        table['lv_x'] = lv[0]
-        table['lv_y'] = lv[1]
-        table['lv_z'] = lv[2]
-
-        av = owner.getAngularVelocity(False)
-        table['av_x'] = av[0]
-        table['av_y'] = av[1]
-        table['av_z'] = av[2]
+        # See _RigidGameObject in netplay/builtin_tables.py
+        table['transform'] = (owner.worldPosition,
+                              owner.worldOrientation.to_quaternion(),
+                              owner.getLinearVelocity(False),
+                              owner.getAngularVelocity(False))
 
-        return packer.to_bytes(table)
-
-    def deserialize(self, table):
-        pos = mathutils.Vector((table['pos_x'], table['pos_y'], table['pos_z']))
-        rot = mathutils.Quaternion((table['rot_x'], table['rot_y'],
-                                    table['rot_z'], table['rot_w']))
-        lv = mathutils.Vector((table['lv_x'], table['lv_y'], table['lv_z']))
-        av = mathutils.Vector((table['av_x'], table['av_y'], table['av_z']))
-
-        owner = self.owner
-        owner.worldPosition = pos
-        owner.worldOrientation = rot
-        owner.setLinearVelocity(lv, False)
-        owner.setAngularVelocity(av, False)
+        return table
 
     def update_client(self):
         return
 
     def CubeSetup(self, table):
-        # We just brute force the setup table for now
+        # Buffered and played back smoothly, see RigidGameObject
         self.deserialize(table)
 
     def update_server(self):
-        # Brute force everything each frame (TODO: Optimize)
-        buff = self.serialize()
+        # A PriorityScheduler sends get_state by itself.  Otherwise only
+        # what changed since each client's last update goes out, resting
+        # cubes cost nothing.
         net = bge.logic.netplay
-
-        net.send_to_clients(buff)
+        if net.scheduler is None:
+            net.send_delta_to_clients(self.get_state())
 
 
 def register_cube(cont):
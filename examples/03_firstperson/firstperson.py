@@ -11,30 +11,27 @@ def define_tables():
 
     tabledef = packer.TableDef('PlayerSetup')
     tabledef.define('uint16', 'id')
-    tabledef.define('float', 'pos_x')
-    tabledef.define('float', 'pos_y')
-    tabledef.define('float', 'pos_z')
-    tabledef.define('float', 'rot_x')
-    tabledef.define('float', 'rot_y')
-    tabledef.define('float', 'rot_z')
-    tabledef.define('float', 'rot_w')
+    tabledef.define('vec3', 'pos')
+    tabledef.define('quat', 'rot')
     tabledef.define('uint8', 'input', 0)
     tabledef.component = Player
 
     tabledef = packer.TableDef('ClientState')
     tabledef.define('uint16', 'id')
     tabledef.define('uint8', 'input', 0)
-    tabledef.define('float', 'rot_x')
-    tabledef.define('float', 'rot_z')
+    # Input sequence for prediction, echoed back by the server
+    tabledef.define('uint16', 'seq', 0)
+    # Euler angles, 2 bytes each is plenty for mouselook
+    tabledef.define('angle16', 'rot_x')
+    tabledef.define('angle16', 'rot_z')
 
     tabledef = packer.TableDef('ClientStatePos')
     tabledef.define('uint16', 'id')
     tabledef.define('uint8', 'input', 0)
-    tabledef.define('float', 'rot_x')
-    tabledef.define('float', 'rot_z')
-    tabledef.define('float', 'pos_x')
-    tabledef.define('float', 'pos_y')
-    tabledef.define('float', 'pos_z')
+    tabledef.define('uint16', 'seq', 0)
+    tabledef.define('angle16', 'rot_x')
+    tabledef.define('angle16', 'rot_z')
+    tabledef.define('vec3', 'pos')
 
     # There should probably be a built-in means of destroying components
     tabledef = packer.TableDef('Destroy')
@@ -51,24 +48,27 @@ def on_connect(self, peer_id):
 
 
 def on_disconnect(self, peer_id):
-    for comp in self.components:
-        if comp is not None and peer_id in comp.permissions:
+    # Copied, removing components reorders the list
+    for comp in list(self.active):
+        if peer_id in comp.permissions:
             comp.permissions.remove(peer_id)
             if len(comp.permissions) == 0:
                 # Destroy the component
-                self.components[comp.net_id] = None
-                comp.owner.endObject()
                 table = packer.Table('Destroy')
                 table.set('id', comp.net_id)
                 buff = packer.to_bytes(table)
 
-                for client in self.clients:
-                    if client is not None and client.peer.incomingPeerID != peer_id:
-                        client.send_reliable(buff)
+                others = [i for i in range(len(self.clients)) if i != peer_id]
+                self.send_to_clients(buff, clients=others, component=comp)
+
+                self.remove_component(comp)
+                comp.owner.endObject()
 
 
 class Player(component.GameObject):
     obj = 'player'
+    # Our own player moves right away, see simulate
+    predict = True
 
     def start(self):
         self.keystate = bitstring.BitArray(bin='00000000')
@@ -91,37 +91,25 @@ class Player(component.GameObject):
         self.expected_position = self.owner.worldPosition.copy()
 
     def start_server(self, args):
-        # Force position sync twice per second, could do more
-        self.pos_timer = 30
-        self.pos_timer_reset = 30
+        # Position sync 10 times per second, the owner reconciles with it
+        self.pos_timer = 6
+        self.pos_timer_reset = 6
+
+        # Last input sequence from the owner
+        self.last_input = 0
 
     def serialize(self):
         table = packer.Table('PlayerSetup')
-        pos = self.owner.worldPosition
-        rot = self.owner.worldOrientation.to_quaternion()
-
         table.set('id', self.net_id)
-        table.set('pos_x', pos[0])
-        table.set('pos_y', pos[1])
-        table.set('pos_z', pos[2])
-        table.set('rot_x', rot[0])
-        table.set('rot_y', rot[1])
-        table.set('rot_z', rot[2])
-        table.set('rot_w', rot[3])
+        table.set('pos', self.owner.worldPosition)
+        table.set('rot', self.owner.worldOrientation.to_quaternion())
         table.set('input', self.keystate.uint)
 
         return packer.to_bytes(table)
 
     def deserialize(self, table):
-        get = table.get
-        pos = (get('pos_x'), get('pos_y'), get('pos_z'))
-        rot = mathutils.Quaternion((get('rot_x'),
-                                    get('rot_y'),
-                                    get('rot_z'),
-                                    get('rot_w')))
-
-        self.owner.worldPosition = pos
-        self.owner.worldOrientation = rot
+        self.owner.worldPosition = table.get('pos')
+        self.owner.worldOrientation = mathutils.Quaternion(table.get('rot'))
 
     def ClientState(self, table):
         if not bge.logic.netplay.server and self.permission:
@@ -129,6 +117,9 @@ class Player(component.GameObject):
             return
 
         self.keystate.uint = table.get('input')
+        if bge.logic.netplay.server:
+            self.last_input = table.get('seq')
+
         rot = mathutils.Euler()
         rot[2] = table.get('rot_z')
         self.owner.worldOrientation = rot
@@ -139,11 +130,13 @@ class Player(component.GameObject):
         # No need to duplicate the first part
         self.ClientState(table)
 
-        # Now interpolate the position...
-        pos = self.expected_position
-        pos[0] = table.get('pos_x')
-        pos[1] = table.get('pos_y')
-        pos[2] = table.get('pos_z')
+        if self.permission:
+            # Rewind to the server's position and replay newer input
+            self.reconcile(table.get('seq'),
+                           mathutils.Vector(table.get('pos')))
+        else:
+            # Now interpolate the position...
+            self.expected_position[:] = table.get('pos')
 
     def Destroy(self, table):
         if bge.logic.netplay.server:
@@ -151,7 +144,7 @@ class Player(component.GameObject):
             return
 
         self.owner.endObject()
-        bge.logic.netplay.components[self.net_id] = None
+        bge.logic.netplay.remove_component(self)
 
     def update_player_input(self):
         held = bge.logic.KX_INPUT_ACTIVE
@@ -192,10 +185,15 @@ class Player(component.GameObject):
 
         self.mouseLook()
 
+        # Move now rather than waiting for the server
+        yaw = self.owner.worldOrientation.to_euler()[2]
+        seq = self.predict_input((self.keystate.uint, yaw))
+
         # Send key state and rotation to server
         table = packer.Table('ClientState')
         table.set('id', self.net_id)
         table.set('input', self.keystate.uint)
+        table.set('seq', seq)
 
         rot = self.head.worldOrientation.to_euler()
         table.set('rot_x', rot[0])
@@ -274,7 +272,14 @@ class Player(component.GameObject):
 
     def update_client(self):
         if self.permission:
+            # Walking is predicted, physics only handles falling
+            owner = self.owner
+            owner.localLinearVelocity = (0.0, 0.0,
+                                         owner.localLinearVelocity[2])
+            owner.applyForce((0.0, 0.0, -9.8), False)
+
             self.update_player_input()
+            return
 
         # Predict movement
         self.move()
@@ -283,22 +288,21 @@ class Player(component.GameObject):
         vel = vel * (1.0 / 60.0)
         self.expected_position += vel
 
-        # Apply correction
-        if self.permission:
-            # Only apply if too far out of sync
-            dist = self.owner.getDistanceTo(self.expected_position)
-            t = bge.logic.netplay.get_ping() / 200.0 # Allowing time x5 variance
-            if dist < self.speed * t:
-                return
-
         self.owner.worldPosition = self.owner.worldPosition.lerp(self.expected_position, 0.1)
 
-    def move(self):
-        owner = self.owner
+    def simulate(self, state, input):
+        # One tick of move() without physics, for prediction
+        keys, yaw = input
+        move = self.get_move(keys)
+        move.rotate(mathutils.Euler((0.0, 0.0, yaw)))
 
-        # Apply input state
-        keys = self.keystate.bin
-        move = mathutils.Vector()
+        step = self.speed / bge.logic.netplay.tick_rate
+        return state + move * step
+
+    def get_move(self, keys):
+        # Input state as a unit vector in local space
+        keys = bitstring.BitArray(uint=keys, length=8).bin
+        move = mathutils.Vector((0.0, 0.0, 0.0))
 
         if keys[0] == '1':
             # Forward
@@ -314,6 +318,13 @@ class Player(component.GameObject):
             move[0] += 1.0
 
         move.normalize()
+        return move
+
+    def move(self):
+        owner = self.owner
+
+        # Apply input state
+        move = self.get_move(self.keystate.uint)
         move = move * self.speed
         move[2] = owner.localLinearVelocity[2]
         owner.localLinearVelocity = move
@@ -334,21 +345,22 @@ class Player(component.GameObject):
             table = packer.Table('ClientStatePos')
             table.set('id', self.net_id)
             table.set('input', self.keystate.uint)
+            # The owner replays whatever input came after this
+            table.set('seq', self.last_input)
 
             rot = self.head.worldOrientation.to_euler()
             table.set('rot_x', rot[0])
             table.set('rot_z', rot[2])
 
-            pos = self.owner.worldPosition
-            table.set('pos_x', pos[0])
-            table.set('pos_y', pos[1])
-            table.set('pos_z', pos[2])
+            table.set('pos', self.owner.worldPosition)
 
         else:
             # Send key state and rotation to clients
             table = packer.Table('ClientState')
             table.set('id', self.net_id)
             table.set('input', self.keystate.uint)
+            # The owner replays whatever input came after this
+            table.set('seq', self.last_input)
 
             rot = self.head.worldOrientation.to_euler()
             table.set('rot_x', rot[0])
@@ -356,7 +368,7 @@ class Player(component.GameObject):
 
         # Send
         buff = packer.to_bytes(table)
-        bge.logic.netplay.send_to_clients(buff)
+        bge.logic.netplay.send_to_clients(buff, component=self)
 
 
 def register_player(cont):
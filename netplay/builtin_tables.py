@@ -9,20 +9,24 @@ def define():
     tabledef = packer.TableDef('_destroy')
     tabledef.define('uint16', 'id')
 
+    # Position and smallest-three rotation in 10 bytes
+    # Positions are quantized within packer.WORLD_BOUNDS
     tabledef = packer.TableDef('_GameObject')
     tabledef.define('uint16', 'id')
-    tabledef.define('float', 'pos_x')
-    tabledef.define('float', 'pos_y')
-    tabledef.define('float', 'pos_z')
-    tabledef.define('float', 'rot_x')
-    tabledef.define('float', 'rot_y')
-    tabledef.define('float', 'rot_z')
-    tabledef.define('float', 'rot_w')
+    tabledef.define('transform', 'transform')
 
-    tabledef = packer.TableDef('_RigidGameObject', template=tabledef)
-    tabledef.define('float', 'lv_x')
-    tabledef.define('float', 'lv_y')
-    tabledef.define('float', 'lv_z')
-    tabledef.define('float', 'av_x')
-    tabledef.define('float', 'av_y')
-    tabledef.define('float', 'av_z')
\ No newline at end of file
+    # Adds linear and angular velocity, 15 bytes for the whole transform
+    tabledef = packer.TableDef('_RigidGameObject')
+    tabledef.define('uint16', 'id')
+    tabledef.define('transform', 'transform', velocity=True, pos_bits=14)
+
+    # Stamped on every packet from the server, see host._Snapshots
+    tabledef = packer.TableDef('_snapshot')
+    tabledef.define('uint16', 'tick')
+    tabledef.define('uint8', 'reliable')
+
+    # Sent back by clients, the newest unreliable tick and a bit for
+    # each of the 32 before it
+    tabledef = packer.TableDef('_ack')
+    tabledef.define('uint16', 'ack')
+    tabledef.define('uint32', 'ack_bits')
\ No newline at end of file
@@ -1,12 +1,137 @@
+import collections
 import logging
 import bge
 import mathutils
 from . import packer
 
 
+class Interpolator:
+    """
+    Client side transform buffer.  States from the server are kept by
+    server time and played back delay seconds behind
+    ClientHost.server_time(), so late or lost packets don't show.  Past
+    the newest state the object keeps its last velocity for at most
+    extrapolate seconds, then stops until more data arrives.
+    """
+
+    def __init__(self, delay=0.1, extrapolate=0.25, size=32):
+        self.delay = delay
+        self.extrapolate = extrapolate
+
+        # (time, position, rotation, velocity), oldest first
+        self.states = collections.deque(maxlen=size)
+
+    def push(self, time, pos, rot, lv=None):
+        pos = mathutils.Vector(pos)
+        rot = mathutils.Quaternion(rot)
+
+        states = self.states
+        if len(states) and time <= states[-1][0]:
+            if time < states[-1][0]:
+                # Already played past it
+                return
+
+            # Same packet as the last one, several ticks can be sent
+            # together.  Read in order, so this one is newer.
+            states.pop()
+
+        if lv is None and len(states):
+            last = states[-1]
+            lv = (pos - last[1]) / (time - last[0])
+
+        if lv is not None:
+            lv = mathutils.Vector(lv)
+
+        states.append((time, pos, rot, lv))
+
+    def sample(self, server_time):
+        # (position, rotation) to show at server_time, None if empty
+        states = self.states
+        if not len(states):
+            return None
+
+        t = server_time - self.delay
+
+        # Drop what has been played, keeping the state before t
+        while len(states) > 1 and states[1][0] <= t:
+            states.popleft()
+
+        a = states[0]
+        if t <= a[0]:
+            return a[1], a[2]
+
+        if len(states) > 1:
+            b = states[1]
+            factor = (t - a[0]) / (b[0] - a[0])
+            return a[1].lerp(b[1], factor), a[2].slerp(b[2], factor)
+
+        # Late, carry on along the last velocity for a little while
+        if a[3] is None:
+            return a[1], a[2]
+        return a[1] + a[3] * min(t - a[0], self.extrapolate), a[2]
+
+    def apply(self, owner, server_time):
+        state = self.sample(server_time)
+        if state is not None:
+            owner.worldPosition = state[0]
+            owner.worldOrientation = state[1]
+
+
+class Prediction:
+    """
+    Inputs a client applied to a component it owns, oldest first, each
+    with its sequence number and the state predicted after it.  The
+    server reports the last sequence it processed along with its state,
+    see GameObject.reconcile.
+    """
+
+    def __init__(self, size=64):
+        # (sequence, input, state)
+        self.history = collections.deque(maxlen=size)
+        self.sequence = 0
+        self.acked = None
+
+    def push(self, input, state):
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        self.history.append((self.sequence, input, state))
+        return self.sequence
+
+    def acknowledge(self, sequence):
+        # Drops inputs up to sequence, False if it's older than the last
+        # one.  The same sequence again is accepted.
+        acked = self.acked
+        if acked is not None and ((sequence - acked) & 0xFFFF) >= 0x8000:
+            return False
+        self.acked = sequence
+
+        history = self.history
+        while len(history) and \
+                ((sequence - history[0][0]) & 0xFFFF) < 0x8000:
+            history.popleft()
+        return True
+
+
 class GameObject:
     obj = None
 
+    # Sent to every client regardless of distance, see interest.py
+    always_relevant = False
+
+    # Smooth out transforms from the server on clients, see Interpolator
+    # and set_transform.  The buffer is created per component.
+    interpolate = False
+    interpolation_delay = 0.1
+    extrapolation_limit = 0.25
+    interpolator = None
+
+    # Client side prediction for owned components, see predict_input
+    predict = False
+    prediction_size = 64
+    prediction = None
+
+    # How fast get_state climbs the PriorityScheduler queue
+    priority = 1.0
+
     def __init__(self, owner, ref=None, args=None):
         net = bge.logic.netplay
         # Weirdass workaround for network-enabled objects in the editor
@@ -33,14 +158,18 @@ class GameObject:
             net.assign_component_id(self)
             self.start_server(args)
 
+            # With interest management it's sent once it's relevant
             buff = self.serialize()
             for c in net.clients:
-                if c is not None:
+                if c is not None and c.relevant is None:
                     c.send_reliable(buff)
 
         else:
             # Clients can only get new network objects from the server
             self.permission = False
+            if self.interpolate:
+                self.interpolator = Interpolator(self.interpolation_delay,
+                                                 self.extrapolation_limit)
             # Setup function defined by serialize will run after construction
             self.start_client()
 
@@ -51,6 +180,11 @@ class GameObject:
 
         self.permissions.append(peer_id)
 
+        # The client needs the component before it can own it
+        net = bge.logic.netplay
+        if net.interest is not None:
+            net.interest.add(net.clients[peer_id], self)
+
         # Notify the client
         table = packer.Table('_permission')
         table.set('id', self.net_id)
@@ -82,19 +216,24 @@ class GameObject:
 
         self.permission = bool(table.get('state'))
 
+        # Predicted inputs only mean something to the current owner
+        if self.permission and self.predict:
+            self.prediction = Prediction(self.prediction_size)
+        else:
+            self.prediction = None
+
     def _destroy(self, table):
         host = bge.logic.netplay
         if host.server:
             # Lets you call _destroy directly on server
             # Also allows clients with permission to self-destruct their object
-            buff = packer.to_bytes(table)
-            for c in host.clients:
-                if c is not None:
-                    c.send_reliable(buff)
+            host.send_to_clients(packer.to_bytes(table), component=self)
 
         if self.owner is not None:
             self.owner.endObject()
 
+        host.remove_component(self)
+
     def start(self):
         """
         Called on both client and server
@@ -125,70 +264,108 @@ class GameObject:
         table = packer.Table('_GameObject')
         table['id'] = self.net_id  # Netplay always requires an ID
 
-        pos = self.owner.worldPosition
-        table['pos_x'] = pos[0]
-        table['pos_y'] = pos[1]
-        table['pos_z'] = pos[2]
-
-        rot = self.owner.worldOrientation.to_quaternion()
-        table['rot_x'] = rot[0]
-        table['rot_y'] = rot[1]
-        table['rot_z'] = rot[2]
-        table['rot_w'] = rot[3]
+        owner = self.owner
+        table['transform'] = (owner.worldPosition,
+                              owner.worldOrientation.to_quaternion())
 
         return packer.to_bytes(table)
 
+    def get_state(self):
+        """
+        Override to return a table for the server's PriorityScheduler to
+        send, it arrives at the handler named after the table.
+        """
+        return None
+
+    def predict_input(self, input):
+        """
+        Client side, for owned components with predict set.  Applies
+        input locally with simulate() and remembers it until the server
+        has processed it.  Returns the sequence number to send along with
+        the input, the server echoes the last one it used.
+        """
+        state = self.simulate(self.get_predicted_state(), input)
+        self.set_predicted_state(state)
+        return self.prediction.push(input, state)
+
+    def reconcile(self, sequence, state):
+        """
+        Client side, takes the server's state after it processed input
+        sequence.  Rewinds to it and replays the inputs the server hasn't
+        seen yet.  Updates older than the last one are ignored, the same
+        sequence again is fine, the server repeats it while input is idle.
+        """
+        prediction = self.prediction
+        if prediction is None or not prediction.acknowledge(sequence):
+            return
+
+        history = prediction.history
+        for i in range(len(history)):
+            sequence, input, old = history[i]
+            state = self.simulate(state, input)
+            history[i] = (sequence, input, state)
+
+        self.set_predicted_state(state)
+
+    def simulate(self, state, input):
+        """
+        Override for prediction, returns the state after input is applied
+        to state for one tick.  Has to match what the server does with
+        the input, and must not touch the object, it runs for replays.
+        """
+        return state
+
+    def get_predicted_state(self):
+        return self.owner.worldPosition.copy()
+
+    def set_predicted_state(self, state):
+        self.owner.worldPosition = state
+
     def deserialize(self, table):
         # Runs on client when object is spawned
-        pos = mathutils.Vector((table['pos_x'], table['pos_y'], table['pos_z']))
-        rot = mathutils.Quaternion((table['rot_x'], table['rot_y'],
-                                    table['rot_z'], table['rot_w']))
+        pos, rot = table['transform']
+        self.set_transform(pos, rot)
 
-        self.owner.worldPosition = pos
-        self.owner.worldOrientation = rot
+    def set_transform(self, pos, rot, lv=None, av=None):
+        """
+        Client side, moves the object to a transform from the server, or
+        buffers it for the interpolator when interpolate is set.
+        """
+        net = bge.logic.netplay
+        if self.interpolator is not None and net.packet_time is not None:
+            self.interpolator.push(net.packet_time, pos, rot, lv)
+            return
+
+        owner = self.owner
+        owner.worldPosition = pos
+        owner.worldOrientation = mathutils.Quaternion(rot)
+        if lv is not None:
+            owner.setLinearVelocity(lv, False)
+        if av is not None:
+            owner.setAngularVelocity(av, False)
 
 
 class RigidGameObject(GameObject):
     # Not totally functional
     obj = None
+    interpolate = True
 
     def serialize(self):
         owner = self.owner
         table = packer.Table('_RigidGameObject')
         table['id'] = self.net_id
 
-        pos = owner.worldPosition
-        table['pos_x'] = pos[0]
-        table['pos_y'] = pos[1]
-        table['pos_z'] = pos[2]
-
-        rot = owner.worldOrientation.to_quaternion()
-        table['rot_x'] = rot[0]
-        table['rot_y'] = rot[1]
-        table['rot_z'] = rot[2]
-        table['rot_w'] = rot[3]
-
-        lv = owner.getLinearVelocity(False)
-        table['lv_x'] = lv[0]
-        table['lv_y'] = lv[1]
-        table['lv_z'] = lv[2]
-
-        av = owner.getAngularVelocity(False)
-        table['av_x'] = av[0]
-        table['av_y'] = av[1]
-        table['av_z'] = av[2]
+        table['transform'] = (owner.worldPosition,
+                              owner.worldOrientation.to_quaternion(),
+                              owner.getLinearVelocity(False),
+                              owner.getAngularVelocity(False))
 
         return packer.to_bytes(table)
 
     def deserialize(self, table):
-        pos = mathutils.Vector((table['pos_x'], table['pos_y'], table['pos_z']))
-        rot = mathutils.Quaternion((table['rot_x'], table['rot_y'],
-                                    table['rot_z'], table['rot_w']))
-        lv = mathutils.Vector((table['lv_x'], table['lv_y'], table['lv_z']))
-        av = mathutils.Vector((table['av_x'], table['av_y'], table['av_z']))
+        pos, rot, lv, av = table['transform']
+        if self.interpolator is not None:
+            # The interpolator moves it, local physics would fight it
+            self.owner.suspendDynamics()
 
-        owner = self.owner
-        owner.worldPosition = pos
-        owner.worldOrientation = rot
-        owner.setLinearVelocity(lv, False)
-        owner.setAngularVelocity(av, False)
\ No newline at end of file
+        self.set_transform(pos, rot, lv, av)
\ No newline at end of file
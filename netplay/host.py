@@ -1,15 +1,231 @@
 from . import network, packer, builtin_tables
 import bge
+import collections
 import logging
+import time
 
 logging.basicConfig(level=logging.INFO)
 
+# Connect data bits, sent by the client to ask for optional features
+_COMPACT_FRAMING = 0x1
+
+# Size of the id fields, the built-in tables use uint16
+_ID_BITS = 16
+
+def _newer(a, b):
+    # Tick comparison that survives wrapping around
+    return a != b and ((a - b) & 0xFFFF) < 0x8000
+
+
+def _pop_stamp(bufflist, name):
+    # Stamps are the last table of a packet
+    if len(bufflist) and \
+            packer.get_tabledef(bufflist[-1]).tableName() == name:
+        return packer.to_table(bufflist.pop())
+    return None
+
+
+class _Snapshot:
+    __slots__ = ('tick', 'time', 'acked')
+
+    def __init__(self, tick, time):
+        self.tick = tick
+        self.time = time
+        self.acked = False
+
+
+class _Snapshots:
+    """
+    Ring buffer of the unreliable packets sent to one client, by server
+    tick.  The client acks them with an _ack table, which gives the round
+    trip time.
+    """
+
+    size = 64
+
+    def __init__(self):
+        self.entries = [None] * self.size
+
+        # Smoothed round trip time in seconds, from acks
+        self.rtt = None
+
+    def sent(self, tick, now):
+        self.entries[tick % self.size] = _Snapshot(tick, now)
+
+    def get(self, tick):
+        entry = self.entries[tick % self.size]
+        if entry is not None and entry.tick == tick:
+            return entry
+        return None
+
+    def ack(self, tick, bits, now):
+        entry = self.get(tick)
+        if entry is not None and not entry.acked:
+            sample = now - entry.time
+            if self.rtt is None:
+                self.rtt = sample
+            else:
+                self.rtt += (sample - self.rtt) * 0.1
+
+        for i in range(33):
+            if i and not bits & (1 << (i - 1)):
+                continue
+
+            entry = self.get((tick - i) & 0xFFFF)
+            if entry is not None:
+                entry.acked = True
+
+
+def _make_clock(tick_rate, send_rate, max_ticks):
+    # Without a tick_rate ticks follow updates at the logic tic rate
+    fixed = tick_rate is not None
+    if not fixed:
+        tick_rate = bge.logic.getLogicTicRate()
+    return TickClock(tick_rate, send_rate, max_ticks, fixed)
+
+
+def _activate(active, component):
+    component._active_index = len(active)
+    active.append(component)
+
+
+def _deactivate(active, component):
+    # Swap-remove, the last component takes the freed spot
+    i = component._active_index
+    last = active.pop()
+    if last is not component:
+        active[i] = last
+        last._active_index = i
+
+    component._active_index = None
+
+
+class _ComponentIDs:
+    """
+    Constant time ID allocation.  Released slots are reused oldest first,
+    so a generation comes back as late as possible.
+    """
+
+    def __init__(self, index_bits, generation_bits):
+        self.index_bits = index_bits
+        self.index_mask = (1 << index_bits) - 1
+        self.generation_mask = (1 << generation_bits) - 1
+        self.generations = [0] * (1 << index_bits)
+        self.free = collections.deque()
+        self.next = 0
+
+    def allocate(self):
+        if len(self.free):
+            index = self.free.popleft()
+        elif self.next <= self.index_mask:
+            index = self.next
+            self.next += 1
+        else:
+            raise IndexError("Out of component IDs")
+
+        return index | self.generations[index] << self.index_bits
+
+    def release(self, net_id):
+        index = net_id & self.index_mask
+        self.generations[index] = (self.generations[index] + 1) & \
+            self.generation_mask
+        self.free.append(index)
+
+
+class TickClock:
+    """
+    Fixed timestep for a host.  With fixed set, real time between updates
+    is banked and spent on ticks of 1 / tick_rate seconds, at most
+    max_ticks per update.  Time beyond that is dropped, so a slow frame
+    can't snowball into slower ones.  Otherwise every update is one tick,
+    which suits BGE's own fixed logic rate.
+
+    Network sends happen every 1 / send_rate seconds of ticks, at most
+    once per update, or after every update that ticked when send_rate is
+    None.  ticks, sends, dropped, frame_ticks, tick_time (seconds spent
+    per tick, smoothed) and alpha (how far into the next tick real time
+    is, for rendering) are kept for profiling.
+    """
+
+    def __init__(self, tick_rate, send_rate=None, max_ticks=5, fixed=True):
+        self.tick_rate = tick_rate
+        self.send_rate = send_rate
+        self.max_ticks = max_ticks
+        self.fixed = fixed
+
+        self.interval = 1.0 / tick_rate
+        self._last = None
+        self._accumulator = 0.0
+        self._send_accumulator = 0.0
+
+        self.ticks = 0
+        self.sends = 0
+        self.dropped = 0
+        self.frame_ticks = 0
+        self.tick_time = 0.0
+        self.alpha = 0.0
+
+    def advance(self, now):
+        # Returns (ticks to run, whether to send) for this update
+        interval = self.interval
+        if not self.fixed:
+            ticks = 1
+        else:
+            last = self._last
+            if last is None:
+                # Start with one tick
+                self._accumulator = interval
+            elif now > last:
+                self._accumulator += now - last
+            self._last = now
+
+            # The epsilon keeps float error from turning a tick per frame
+            # into none then two
+            ticks = int(self._accumulator / interval + 1e-6)
+            self._accumulator -= ticks * interval
+            if ticks > self.max_ticks:
+                self.dropped += ticks - self.max_ticks
+                ticks = self.max_ticks
+            self.alpha = self._accumulator / interval
+
+        self.frame_ticks = ticks
+        self.ticks += ticks
+        if not ticks:
+            return 0, False
+
+        send = True
+        if self.send_rate is not None:
+            period = 1.0 / self.send_rate
+            self._send_accumulator += ticks * interval
+            # The remainder carries over, so rates that don't divide the
+            # tick rate still average out.  The epsilon is only against
+            # rounding, 60 / 20 is 3 ticks.
+            send = self._send_accumulator >= period - 1e-9
+            if send:
+                self._send_accumulator -= period
+                if self._send_accumulator > period:
+                    # At most one send per update, catch-up is dropped
+                    self._send_accumulator %= period
+
+        if send:
+            self.sends += 1
+        return ticks, send
+
+    def measure(self, seconds):
+        # Time the last frame_ticks ticks took
+        if self.frame_ticks:
+            per_tick = seconds / self.frame_ticks
+            self.tick_time += (per_tick - self.tick_time) * 0.1
+
 
 class ServerHost:
 
     server = True
 
-    def __init__(self, interface='', port=54303, version=0, maxclients=10, offline=False):
+    def __init__(self, interface='', port=54303, version=0, maxclients=10, offline=False,
+                 compressor=None, pooling=False, compact=False, interest=None,
+                 scheduler=None, tick_rate=None, send_rate=None, max_ticks=5,
+                 index_bits=16, generation_bits=0):
         builtin_tables.define()
 
         # Handy for server lists
@@ -17,10 +233,50 @@ class ServerHost:
         self.version = version
         self.maxclients = maxclients
 
+        # Optional packer.PacketCompressor, clients need the same dictionary
+        self.compressor = compressor
+
+        # Reuse received tables once their handler returns, handlers that
+        # keep one have to call table.materialize()
+        self.pooling = pooling
+
+        # Send compact packets to clients that ask for them, see
+        # packer.PacketWriter.  Either kind is read from anyone.
+        self.compact = compact
+
+        # Optional interest.InterestManager, otherwise every client gets
+        # every component
+        self.interest = interest
+
+        # Optional interest.PriorityScheduler for component state
+        self.scheduler = scheduler
+
+        # Stamped on every packet, see _Snapshots
+        self.tick = 0
+
+        # Components update tick_rate times per second of real time and
+        # clients are sent to send_rate times, see TickClock.  Without a
+        # tick_rate both happen once per update.
+        self.clock = _make_clock(tick_rate, send_rate, max_ticks)
+        self.tick_rate = self.clock.tick_rate
+
         # Client ID == enet peer ID
         self.clients = [None] * maxclients
-        self.components = [None] * 65535
-        self.last_component = 0 # Saves some iteration while looping
+
+        # Component IDs are a slot in components in the low index_bits and
+        # a count of how often that slot was reused above it, so packets
+        # for a destroyed component can't reach the next one.  Both have
+        # to fit the id fields, uint16 by default, and clients have to
+        # use the same split.  The default keeps every bit for slots.
+        if index_bits + generation_bits > _ID_BITS:
+            raise ValueError("index_bits + generation_bits must be at most "
+                             "{}".format(_ID_BITS))
+        self._ids = _ComponentIDs(index_bits, generation_bits)
+        self.index_mask = self._ids.index_mask
+        self.components = [None] * (1 << index_bits)
+
+        # Live components in no particular order, for looping over
+        self.active = []
 
         if offline:
             self.network = None
@@ -37,16 +293,36 @@ class ServerHost:
             logging.info('Server started')
 
     def assign_component_id(self, component):
-        i = 0
-        for comp in self.components:
-            if comp is None:
-                self.components[i] = component
-                component.net_id = i
-                if i > self.last_component:
-                    self.last_component = i
-                return
+        net_id = self._ids.allocate()
+        self.components[net_id & self.index_mask] = component
+        component.net_id = net_id
+        _activate(self.active, component)
+
+        # Clients without interest management get the spawn right away,
+        # see GameObject.__init__
+        for c in self.clients:
+            if c is not None and c.relevant is None:
+                c.spawning.add(component)
+
+    def remove_component(self, component):
+        """
+        Stops updating the component and frees its ID for reuse.  Its
+        net_id stays invalid until the slot has gone through every
+        generation.  Telling clients and ending the object is up to you.
+        """
+        i = component.net_id & self.index_mask
+        if self.components[i] is not component:
+            logging.warning('Component was already removed')
+            return
+
+        self.components[i] = None
+        _deactivate(self.active, component)
+        self._ids.release(component.net_id)
 
-            i += 1
+        if self.interest is not None:
+            self.interest.forget(self, component)
+        if self.scheduler is not None:
+            self.scheduler.forget(self, component)
 
     def on_connect(self, peer_id):
         """
@@ -60,28 +336,25 @@ class ServerHost:
         """
         return
 
-    def _addClient(self, peer):
+    def _addClient(self, peer, data=0):
         peerID = peer.incomingPeerID
         if self.clients[peerID] is not None:
             logging.error('Client ID in use: {}'.format(peerID))
             peer.reset()
             return
 
-        client = _Client(peer)
+        compact = self.compact and bool(data & _COMPACT_FRAMING)
+        client = _Client(peer, compact)
         self.clients[peerID] = client
 
-        # Send everything!
-        i = 0
-        for comp in self.components:
-            if i > self.last_component:
-                break
-
-            i += 1
-
-            if comp is None:
-                continue
-
-            client.send_reliable(comp.serialize())
+        if self.interest is not None:
+            # Components are sent as they become relevant
+            client.relevant = set()
+        else:
+            # Send everything!
+            for comp in self.active:
+                client.send_reliable(comp.serialize())
+                client.spawning.add(comp)
 
         # User-defined
         self.on_connect(peerID)
@@ -98,22 +371,31 @@ class ServerHost:
         self.on_disconnect(peerID)
 
     def _update_components(self):
-        i = 0
-        last = self.last_component
-        for comp in self.components:
-            if i > last:
-                return
-
-            i += 1
-
-            if comp is None:
+        # Components added during the loop wait for the next tick, removed
+        # ones are skipped
+        for comp in tuple(self.active):
+            if comp._active_index is None:
                 continue
 
             comp.update()
             comp.update_server()
 
     def update(self):
-        self._update_components()
+        clock = self.clock
+        ticks, send = clock.advance(time.time())
+
+        start = time.perf_counter()
+        for i in range(ticks):
+            self.tick = (self.tick + 1) & 0xFFFF
+            self._update_components()
+        clock.measure(time.perf_counter() - start)
+
+        if send:
+            if self.interest is not None:
+                self.interest.update(self)
+
+            if self.scheduler is not None:
+                self.scheduler.update(self)
 
         if self.network is None:
             # Flush queued data
@@ -135,7 +417,7 @@ class ServerHost:
             elif event.type == network.EVENT_TYPE_CONNECT:
                 logging.info("{} connecting".format(event.peer.address))
                 ## TODO - check version
-                self._addClient(event.peer)
+                self._addClient(event.peer, event.data)
 
             elif event.type == network.EVENT_TYPE_DISCONNECT:
                 logging.info("{} disconnecting".format(event.peer.address))
@@ -144,106 +426,240 @@ class ServerHost:
 
             elif event.type == network.EVENT_TYPE_RECEIVE:
                 peerID = event.peer.incomingPeerID
-                bufflist = packer.unjoin_buffers(event.packet.data)
+                data = event.packet.data
+                if self.compressor is not None:
+                    data = self.compressor.decompress(data)
+                    if data is None:
+                        logging.warning('Dropped a packet that inflates past max_size')
+                        continue
+
+                bufflist = packer.unjoin_buffers(data)
+
+                stamp = _pop_stamp(bufflist, '_ack')
+                if stamp is not None:
+                    self.clients[peerID].snapshots.ack(
+                        stamp.get('ack'), stamp.get('ack_bits'), time.time())
 
                 for buff in bufflist:
-                    table = packer.to_table(buff)
+                    # Fields are decoded as handlers read them, handlers
+                    # that keep the table need to call table.materialize()
+                    table = packer.to_table(buff, lazy=True,
+                                            pooled=self.pooling)
                     table.source = peerID
                     # Find the component by ID
-                    component = self.components[table.get('id')]
+                    net_id = table.get('id')
+                    component = self.components[net_id & self.index_mask]
 
-                    if component is None:
+                    if component is None or component.net_id != net_id:
                         logging.info('Received data for a non-existent component.  This is acceptable for unreliable data.')
-                        continue
-
-                    # Check for permissions
-                    if peerID in component.permissions:
+                    elif peerID in component.permissions:
                         # Run the associated method
                         getattr(component, table.tableName())(table)
                     else:
                         logging.warning('Client does not have input permission')
 
-        self._send_queued_data()
+                    if self.pooling:
+                        packer.release(table)
+
+        if send:
+            self._send_queued_data()
 
     def _send_queued_data(self):
         if self.network is None:
             return
 
+        stamp = packer.Table('_snapshot')
+        stamp['tick'] = self.tick
+        stamp['reliable'] = 0
+        unreliable = packer.to_bytes(stamp)
+        stamp['reliable'] = 1
+        reliable = packer.to_bytes(stamp)
+
+        now = time.time()
         for c in self.clients:
             if c is not None:
                 if len(c.unreliable):
-                    joined_buffers = packer.join_buffers(c.unreliable)
-                    c.unreliable = []
-                    self.network.send(c.peer, joined_buffers, reliable=False)
+                    c.snapshots.sent(self.tick, now)
+                c.flush(self.network, self.compressor, (unreliable, reliable))
 
-                channel = 0
-                for ch in c.reliable:
-                    if len(ch):
-                        joined_buffers = packer.join_buffers(ch)
-                        self.network.send(c.peer, joined_buffers, reliable=True,
-                                          channel=channel)
+    def send_delta_to_clients(self, table, channel=0, clients=None):
+        """
+        Sends only the fields of table that changed since the last delta
+        each client got for that component, nothing if it's unchanged.
+        Always reliable, keep a component's deltas on one channel.
+        """
+        if clients is None:
+            clients = self.clients
+        else:
+            clients = [self.clients[peer_id] for peer_id in clients]
 
-                    channel += 1
+        net_id = table.get('id')
+        component = self.components[net_id & self.index_mask]
 
-                c.reliable = [[]] * c.channels
+        for c in clients:
+            if c is not None:
+                if c.relevant is not None and component not in c.relevant:
+                    continue
 
-    def send_to_clients(self, buff, reliable=True, channel=0, clients=None):
-        if clients is None:
-            if reliable:
-                for c in self.clients:
-                    if c is not None:
-                        c.send_reliable(buff, channel)
-            else:
-                for c in self.clients:
-                    if c is not None:
-                        c.send(buff)
+                buff = packer.to_delta_bytes(table, c.baselines)
+                if buff is not None:
+                    c.send_reliable(buff, channel)
 
+    def send_to_clients(self, buff, reliable=True, channel=0, clients=None,
+                        component=None):
+        """
+        With interest management, pass the component buff is about and it
+        only goes to the clients it is relevant to.
+        """
+        if clients is None:
+            clients = self.clients
         else:
-            for peer_id in clients:
-                c = self.clients[peer_id]
-                if c is not None:
-                    if reliable:
-                        c.send_reliable(buff, channel)
-                    else:
-                        c.send(buff)
+            clients = [self.clients[peer_id] for peer_id in clients]
+
+        for c in clients:
+            if c is not None:
+                if component is not None and c.relevant is not None and \
+                        component not in c.relevant:
+                    continue
+
+                if reliable:
+                    c.send_reliable(buff, channel)
+                else:
+                    c.send_unreliable(buff)
 
 
 class _Client:
 
-    def __init__(self, peer):
+    def __init__(self, peer, compact=False):
         self.peer = peer
 
-        # Store queued data here
-        self.unreliable = []
+        # Queued data is packed straight into reusable packet buffers
+        self.unreliable = packer.PacketWriter(compact=compact)
 
         # Pretty sure ENet supports 256 channels
         # But that's a lot of iteration.  Modify if here you need more.
         self.channels = 4
-        self.reliable = [[]] * self.channels
+        self.reliable = [packer.PacketWriter(compact=compact)
+                         for i in range(self.channels)]
+
+        # Last state sent with send_delta_to_clients, per table and component
+        # Reliable channels are ordered, so the client holds the same state
+        # by the time a delta arrives.
+        self.baselines = {}
+
+        # Components this client knows about, None without interest
+        # management
+        self.relevant = None
+
+        # PriorityScheduler accumulators, by component
+        self.priorities = {}
+
+        # Components whose spawn goes out with the next flush.  Their
+        # state waits a send, unreliable data can beat the spawn there.
+        self.spawning = set()
+
+        # Server side, what was sent and acked
+        self.snapshots = _Snapshots()
 
     def send_unreliable(self, buff):
-        self.unreliable.append(buff)
+        # Accepts packed bytes or a packer.Table
+        if isinstance(buff, packer.Table):
+            self.unreliable.write_table(buff)
+        else:
+            self.unreliable.write(buff)
 
     def send_reliable(self, buff, channel=0):
-        self.reliable[channel].append(buff)
+        if isinstance(buff, packer.Table):
+            self.reliable[channel].write_table(buff)
+        else:
+            self.reliable[channel].write(buff)
+
+    @property
+    def compact(self):
+        return self.unreliable.compact
+
+    def set_compact(self, compact):
+        # Only between flushes, the writers have to be empty
+        self.unreliable.compact = compact
+        for writer in self.reliable:
+            writer.compact = compact
+
+    def flush(self, network, compressor=None, stamps=None):
+        # Sends everything queued, one packet per non-empty buffer
+        # stamps are packed tables ending unreliable and reliable packets
+        self.spawning.clear()
+
+        writer = self.unreliable
+        if len(writer):
+            if stamps is not None:
+                writer.write(stamps[0])
+            buff = writer.finish()
+            if compressor is not None:
+                buff = compressor.compress(buff)
+            network.send(self.peer, buff, reliable=False)
+            writer.clear()
+
+        channel = 0
+        for writer in self.reliable:
+            if len(writer):
+                if stamps is not None:
+                    writer.write(stamps[1])
+                buff = writer.finish()
+                if compressor is not None:
+                    buff = compressor.compress(buff)
+                network.send(self.peer, buff, reliable=True, channel=channel)
+                writer.clear()
+
+            channel += 1
 
 
 class ClientHost:
 
     server = False
 
-    def __init__(self, server_ip='127.0.0.1', server_port=54303, version=0):
+    def __init__(self, server_ip='127.0.0.1', server_port=54303, version=0,
+                 compressor=None, pooling=False, compact=False, tick_rate=None,
+                 send_rate=None, max_ticks=5, index_bits=16):
         builtin_tables.define()
 
         self.server_ip = server_ip
         self.server_port = server_port
 
+        # See ServerHost.  Asked for when connecting, and used for sending
+        # once the server has been seen answering in kind.
+        self.compact = compact
+        self._server_compact = False
+
+        # See ServerHost
+        self.compressor = compressor
+        self.pooling = pooling
+
         self.connected = False
         self.network = network.ENetWrapper(server=False)
-        self.serverPeer = self.network.connect(server_ip, server_port)
-
-        self.components = [None] * 65535
-        self.last_component = 0 # Saves some iteration while looping
+        data = _COMPACT_FRAMING if compact else 0
+        self.serverPeer = self.network.connect(server_ip, server_port, data)
+
+        # See ServerHost, index_bits has to match the server's
+        if index_bits > _ID_BITS:
+            raise ValueError("index_bits must be at most {}".format(_ID_BITS))
+        self.index_mask = (1 << index_bits) - 1
+        self.components = [None] * (1 << index_bits)
+        self.active = []
+
+        # Delta baselines, see ServerHost.send_delta_to_clients
+        self.baselines = {}
+
+        # Newest server tick seen, and the tick of the packet being read
+        # so handlers can tell how old it is
+        self.tick = None
+        self.packet_tick = None
+        self._reset_acks()
+
+        # See ServerHost.  tick_rate should match the server's, it's also
+        # used to read the server clock, see server_time.
+        self.clock = _make_clock(tick_rate, send_rate, max_ticks)
+        self.tick_rate = self.clock.tick_rate
+        self._reset_clock()
 
         # Works the same, may as well re-use this code
         self._wrapper = _Client(self.serverPeer)
@@ -254,6 +670,83 @@ class ClientHost:
         else:
             self._wrapper.send_unreliable(buff)
 
+    def _reset_acks(self):
+        self._ack = None
+        self._ack_bits = 0
+
+    def _reset_clock(self):
+        self._ticks = 0
+        self._clock_offset = None
+
+        # Server time of the packet being read, in seconds
+        self.packet_time = None
+
+    def server_time(self):
+        """
+        Estimated server time in seconds, as of the newest packets.  It
+        runs behind the real one by the trip time, which is what received
+        states can be compared with.  None until the first packet.
+        """
+        if self._clock_offset is None:
+            return None
+        return time.time() + self._clock_offset
+
+    def _read_stamp(self, stamp):
+        # Returns False for unreliable packets that should be dropped
+        tick = stamp.get('tick')
+        if not stamp.get('reliable') and not self._receive_tick(tick):
+            # Unreliable data older than what we already have
+            return False
+
+        if self.tick is None or _newer(tick, self.tick):
+            # Ticks are unwrapped into _ticks for the clock
+            if self.tick is not None:
+                self._ticks += (tick - self.tick) & 0xFFFF
+            self.tick = tick
+
+            sample = self._ticks / self.tick_rate - time.time()
+            offset = self._clock_offset
+            if offset is None or abs(sample - offset) > 0.25:
+                self._clock_offset = sample
+            else:
+                # Smoothed, so jitter doesn't shake interpolation
+                self._clock_offset = offset + (sample - offset) * 0.05
+
+        self.packet_tick = tick
+        age = (self.tick - tick) & 0xFFFF
+        self.packet_time = (self._ticks - age) / self.tick_rate
+        return True
+
+    def _receive_tick(self, tick):
+        # Marks an unreliable tick received, False if a newer one was
+        # already read
+        ack = self._ack
+        if ack is None or _newer(tick, ack):
+            if ack is not None:
+                shift = (tick - ack) & 0xFFFF
+                if shift > 32:
+                    self._ack_bits = 0
+                else:
+                    bits = (self._ack_bits << 1 | 1) << (shift - 1)
+                    self._ack_bits = bits & 0xFFFFFFFF
+            self._ack = tick
+            return True
+
+        age = (ack - tick) & 0xFFFF
+        if 0 < age <= 32:
+            self._ack_bits |= 1 << (age - 1)
+        return False
+
+    def remove_component(self, component):
+        # Run when a component is destroyed, the server hands out its IDs
+        i = component.net_id & self.index_mask
+        if self.components[i] is not component:
+            logging.warning('Component was already removed')
+            return
+
+        self.components[i] = None
+        _deactivate(self.active, component)
+
     def on_connect(self):
         print ("Connected")
 
@@ -263,23 +756,37 @@ class ClientHost:
     def get_ping(self):
         return self.serverPeer.roundTripTime
 
-    def _update_components(self):
-        i = 0
-        last = self.last_component
-        for comp in self.components:
-            if i > last:
-                return
+    def _interpolate(self):
+        # Every update rather than every tick, it's only for looks.
+        # Components this client predicts are left alone.
+        now = self.server_time()
+        if now is None:
+            return
 
-            i += 1
+        for comp in self.active:
+            if comp.interpolator is not None and comp.prediction is None:
+                comp.interpolator.apply(comp.owner, now)
 
-            if comp is None:
+    def _update_components(self):
+        # See ServerHost
+        for comp in tuple(self.active):
+            if comp._active_index is None:
                 continue
 
             comp.update()
             comp.update_client()
 
     def update(self):
-        self._update_components()
+        clock = self.clock
+        ticks, send = clock.advance(time.time())
+
+        # Interpolated components are placed before updates run
+        self._interpolate()
+
+        start = time.perf_counter()
+        for i in range(ticks):
+            self._update_components()
+        clock.measure(time.perf_counter() - start)
 
         event_backlog = []
         if self.network.threaded:
@@ -308,49 +815,83 @@ class ClientHost:
                     break
 
                 self.connected = False
+                self.baselines.clear()
+                self._server_compact = False
+                self.tick = None
+                self.packet_tick = None
+                self._reset_acks()
+                self._reset_clock()
                 self.on_disconnect()
 
             elif event.type == network.EVENT_TYPE_RECEIVE:
-                bufflist = packer.unjoin_buffers(event.packet.data)
+                data = event.packet.data
+                if self.compressor is not None:
+                    data = self.compressor.decompress(data)
+                    if data is None:
+                        logging.warning('Dropped a packet that inflates past max_size')
+                        continue
+
+                if self.compact and packer.is_compact(data):
+                    self._server_compact = True
+
+                bufflist = packer.unjoin_buffers(data)
+
+                stamp = _pop_stamp(bufflist, '_snapshot')
+                if stamp is not None and not self._read_stamp(stamp):
+                    continue
+
+                # Only reliable data can spawn, unreliable data can arrive
+                # after the component was despawned
+                reliable = stamp is None or stamp.get('reliable')
+
                 for buff in bufflist:
-                    table = packer.to_table(buff)
+                    # See ServerHost.update about lazy tables
+                    table = packer.to_table(buff, self.baselines, lazy=True,
+                                            pooled=self.pooling)
                     # Find the component by ID
                     net_id = table.get('id')
-                    component = self.components[net_id]
-
-                    if component is None:
+                    i = net_id & self.index_mask
+                    component = self.components[i]
+
+                    if component is not None and component.net_id != net_id:
+                        # Reliable data is ordered, so the slot's current
+                        # component is newer than this
+                        logging.info('Received data for a destroyed component')
+                    elif component is None:
                         # Component doesn't exist.  Assume this is for creation.
                         comp = getattr(table._tabledef, 'component', None)
-                        if comp is None:
+                        if not reliable:
+                            logging.info('Received unreliable data for a missing component')
+                        elif comp is None:
                             logging.error('Missing expected component in table {}'.format(table.tableName()))
                         else:
                             component = comp(None)
                             component.net_id = net_id
-                            self.components[net_id] = component
-                            if net_id > self.last_component:
-                                self.last_component = net_id
+                            self.components[i] = component
+                            _activate(self.active, component)
 
                             component.deserialize(table)
                     else:
                         # Run the associated method
                         getattr(component, table.tableName())(table)
 
-        self._send_queued_data()
+                    if self.pooling:
+                        packer.release(table)
+
+        if send:
+            self._send_queued_data()
 
     def _send_queued_data(self):
         c = self._wrapper
-        if len(c.unreliable):
-            joined_buffers = packer.join_buffers(c.unreliable)
-            c.unreliable = []
-            self.network.send(c.peer, joined_buffers, reliable=False)
 
-        channel = 0
-        for ch in c.reliable:
-            if len(ch):
-                joined_buffers = packer.join_buffers(ch)
-                self.network.send(c.peer, joined_buffers, reliable=True,
-                                  channel=channel)
+        # Acks go out with every send, whether or not there's anything else
+        if self._ack is not None:
+            table = packer.Table('_ack')
+            table['ack'] = self._ack
+            table['ack_bits'] = self._ack_bits
+            c.send_unreliable(table)
 
-            channel += 1
+        c.flush(self.network, self.compressor)
 
-        c.reliable = [[]] * c.channels
\ No newline at end of file
+        if c.compact != self._server_compact:
+            c.set_compact(self._server_compact)
@@ -0,0 +1,274 @@
+import collections
+import math
+from . import packer
+
+
+class SpatialGrid:
+    """
+    Uniform hash grid of components by world position.  Cells are columns
+    over x and y (z is up in BGE), so height doesn't add cells to search.
+    """
+
+    def __init__(self, cell_size=32.0):
+        self.cell_size = cell_size
+        self.cells = {}
+
+        # Per component: its cell and the position it was filed under
+        self._cell = {}
+        self.positions = {}
+
+    def _key(self, x, y):
+        size = self.cell_size
+        return (int(math.floor(x / size)), int(math.floor(y / size)))
+
+    def move(self, component, pos):
+        # Adds the component or moves it to its current position
+        x, y, z = pos[0], pos[1], pos[2]
+        self.positions[component] = (x, y, z)
+
+        key = self._key(x, y)
+        old = self._cell.get(component, None)
+        if old == key:
+            return
+
+        if old is not None:
+            self._discard(old, component)
+
+        cell = self.cells.get(key, None)
+        if cell is None:
+            cell = self.cells[key] = set()
+        cell.add(component)
+        self._cell[component] = key
+
+    def remove(self, component):
+        old = self._cell.pop(component, None)
+        if old is not None:
+            self._discard(old, component)
+            del self.positions[component]
+
+    def _discard(self, key, component):
+        cell = self.cells[key]
+        cell.discard(component)
+        if not len(cell):
+            del self.cells[key]
+
+    def query(self, pos, radius):
+        # Components within radius of pos
+        x, y, z = pos[0], pos[1], pos[2]
+        low_x, low_y = self._key(x - radius, y - radius)
+        high_x, high_y = self._key(x + radius, y + radius)
+        limit = radius * radius
+        cells = self.cells
+        positions = self.positions
+
+        found = []
+        for cx in range(low_x, high_x + 1):
+            for cy in range(low_y, high_y + 1):
+                cell = cells.get((cx, cy), None)
+                if cell is None:
+                    continue
+
+                for component in cell:
+                    px, py, pz = positions[component]
+                    dx = px - x
+                    dy = py - y
+                    dz = pz - z
+                    if dx * dx + dy * dy + dz * dz <= limit:
+                        found.append(component)
+
+        return found
+
+
+class InterestManager:
+    """
+    Decides which components each client hears about.  A component is
+    relevant to a client when it is within radius of a component the
+    client has permission for, or of one given to set_focus.  Components
+    with always_relevant set, or without an owner, go to everyone.
+
+    Clients are sent the component's serialize() when it becomes relevant
+    and a _destroy table when it stops being relevant.  ServerHost keeps
+    updates for anything else off the client, see send_to_clients.
+
+    Pass one to ServerHost(interest=...), it is updated with every send,
+    see TickClock.
+    """
+
+    def __init__(self, radius=64.0, cell_size=None):
+        if cell_size is None:
+            cell_size = radius
+
+        self.radius = radius
+        self.grid = SpatialGrid(cell_size)
+        self.focus = {}
+
+    def set_focus(self, peer_id, component):
+        # Watch from this component too, e.g. a spectator camera
+        # Pass None to clear it
+        if component is None:
+            self.focus.pop(peer_id, None)
+        else:
+            self.focus[peer_id] = component
+
+    def update(self, host):
+        grid = self.grid
+        everyone = []
+        owned = collections.defaultdict(list)
+
+        for comp in host.active:
+            for peer_id in comp.permissions:
+                owned[peer_id].append(comp)
+
+            owner = comp.owner
+            if owner is None or comp.always_relevant:
+                everyone.append(comp)
+            else:
+                grid.move(comp, owner.worldPosition)
+
+        radius = self.radius
+        peer_id = 0
+        for client in host.clients:
+            if client is not None and client.relevant is not None:
+                viewpoints = owned.get(peer_id, [])
+                relevant = set(everyone)
+                relevant.update(viewpoints)
+
+                focus = self.focus.get(peer_id, None)
+                if focus is not None:
+                    viewpoints = viewpoints + [focus]
+
+                for comp in viewpoints:
+                    if comp.owner is not None:
+                        relevant.update(grid.query(comp.owner.worldPosition,
+                                                   radius))
+
+                old = client.relevant
+                for comp in relevant - old:
+                    self._spawn(client, comp)
+                for comp in old - relevant:
+                    self._despawn(client, comp)
+
+                client.relevant = relevant
+
+            peer_id += 1
+
+    def add(self, client, component):
+        # Makes component relevant right away, before the next update
+        relevant = client.relevant
+        if relevant is not None and component not in relevant:
+            relevant.add(component)
+            self._spawn(client, component)
+
+    def forget(self, host, component):
+        # Run by ServerHost.remove_component
+        self.grid.remove(component)
+        for client in host.clients:
+            if client is not None and client.relevant is not None:
+                client.relevant.discard(component)
+
+        for peer_id, focus in list(self.focus.items()):
+            if focus is component:
+                del self.focus[peer_id]
+
+    def _spawn(self, client, component):
+        client.send_reliable(component.serialize())
+        client.spawning.add(component)
+
+    def _despawn(self, client, component):
+        table = packer.Table('_destroy')
+        table['id'] = component.net_id
+        client.send_reliable(table)
+
+        # The next delta for it has to be a keyframe
+        net_id = component.net_id
+        for key in [k for k in client.baselines if k[1] == net_id]:
+            del client.baselines[key]
+
+
+class PriorityScheduler:
+    """
+    Sends component state within a byte budget per client and send.
+    Components that return a table from get_state() take part.  Each
+    send every relevant one adds relevance() to its accumulator for that
+    client, and the states are queued from the highest accumulator down
+    until the budget is spent.  Sending resets the accumulator, so
+    anything skipped keeps climbing until it gets through.  The top one
+    always goes, even when it alone is over budget.
+
+    Data queued by other means counts against the budget but is never
+    held back.  States go out unreliable, as to_bytes, starting the send
+    after the component's spawn.
+
+    Pass one to ServerHost(scheduler=...).
+    """
+
+    def __init__(self, budget=1200):
+        self.budget = budget
+
+    def relevance(self, peer_id, component):
+        # How fast the component climbs for this client, override for
+        # e.g. distance
+        return component.priority
+
+    def update(self, host):
+        states = []
+        for comp in host.active:
+            table = comp.get_state()
+            if table is not None:
+                states.append((comp, table))
+
+        # Packed on first use, shared by all clients
+        packed = {}
+
+        peer_id = 0
+        for client in host.clients:
+            if client is not None:
+                self._fill(peer_id, client, states, packed)
+            peer_id += 1
+
+    def _fill(self, peer_id, client, states, packed):
+        accumulators = client.priorities
+        relevant = client.relevant
+        spawning = client.spawning
+
+        candidates = []
+        for comp, table in states:
+            if relevant is not None and comp not in relevant:
+                continue
+
+            # Would race its own spawn, it goes with the next send
+            if comp in spawning:
+                continue
+
+            priority = accumulators.get(comp, 0.0) + \
+                self.relevance(peer_id, comp)
+            accumulators[comp] = priority
+            candidates.append((priority, comp, table))
+
+        if not len(candidates):
+            return
+
+        remaining = self.budget - len(client.unreliable)
+        for writer in client.reliable:
+            remaining -= len(writer)
+
+        candidates.sort(key=lambda c: c[0], reverse=True)
+        first = True
+        for priority, comp, table in candidates:
+            buff = packed.get(comp, None)
+            if buff is None:
+                buff = packed[comp] = packer.to_bytes(table)
+
+            # 2 bytes of framing
+            size = len(buff) + 2
+            if size <= remaining or first:
+                client.send_unreliable(buff)
+                accumulators[comp] = 0.0
+                remaining -= size
+                first = False
+
+    def forget(self, host, component):
+        # Run by ServerHost.remove_component
+        for client in host.clients:
+            if client is not None:
+                client.priorities.pop(component, None)
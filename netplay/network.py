@@ -47,9 +47,9 @@ class ENetWrapper:
         # More wrapper stuff
         #self.service = self._host.service
 
-    def connect(self, server_ip, server_port):
-        # For clients
-        return self._host.connect(enet.Address(server_ip, server_port), 1)
+    def connect(self, server_ip, server_port, data=0):
+        # For clients, data shows up as event.data in the server's connect event
+        return self._host.connect(enet.Address(server_ip, server_port), 1, data)
 
     def send(self, peer, buff, reliable=True, channel=0):
         if reliable:
@@ -57,6 +57,7 @@ class ENetWrapper:
         else:
             flag = enet.PACKET_FLAG_UNSEQUENCED
 
+        # buff may be the bytearray from a PacketWriter, enet copies it
         packet = enet.Packet(buff, flag)
         peer.send(channel, packet)
 
@@ -1,8 +1,16 @@
 import collections
 import copy
 import json
+import math
 import struct
 import warnings
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    # Only needed for TableDef.encode_many and friends
+    numpy = None
 
 
 _DATA_TYPES = {}
@@ -16,63 +24,372 @@ _DATA_TYPES['int32'] = 'i'
 _DATA_TYPES['uint32'] = 'I'
 _DATA_TYPES['int64'] = 'q'
 _DATA_TYPES['uin64'] = 'Q'
-_DATA_TYPES['json'] = 'json'
+_DATA_TYPES['half'] = 'e'
+
+# numpy equivalents of the struct formats, without byte order
+_NUMPY_TYPES = {
+    'f': 'f4', 'd': 'f8', 'e': 'f2',
+    'b': 'i1', 'B': 'u1', 'h': 'i2', 'H': 'u2',
+    'i': 'i4', 'I': 'u4', 'q': 'i8', 'Q': 'u8',
+}
+
+# Variable-length types, sent after the fixed fields as a varint length
+# followed by the data.  Filled in below.
+_VAR_TYPES = {}
+
+# Field types that convert values on the way in and out
+# Each entry builds a codec from the options given to define
+_FIELD_TYPES = {}
+
+# Default position range for transform fields, (min xyz, max xyz)
+# Change this before the tables are defined to fit your level.
+WORLD_BOUNDS = ((-256.0, -256.0, -256.0), (256.0, 256.0, 256.0))
 
 _TABLES = {}
 _TABLE_LIST = []
 
+# Framing
+_LENGTH = struct.Struct('!H')
+_SMALL_VARINTS = [bytes((i,)) for i in range(0x80)]
+_TABLE_ID = struct.Struct('!H')
+
+# Compressed packets start with a zero length, which no table can have
+_COMPRESSED = b'\x00\x00'
+
+# Same for compact packets, a table is at least its 2 byte ID
+# See PacketWriter.compact
+_COMPACT = b'\x00\x01'
+
+# Placeholder for fields of lazy tables that haven't been read yet
+_UNDECODED = object()
+
+# Released tables kept for reuse, per TableDef
+_POOL_SIZE = 64
+
+# Fields a lazy table decodes one by one before it decodes the rest at
+# once, handlers that read everything shouldn't pay per field
+_LAZY_MISSES = 1
+
+# The top bits of the table ID mark delta and sparse encoded tables
+_ID_MASK = 0x3FFF
+_DELTA = 0x8000
+_KEYFRAME = 0x4000
+_SPARSE = _DELTA | _KEYFRAME
+
 
 def join_buffers(bufflist):
     # Aggregates small buffers to reduce packet overhead
     # There is no length limit.  We expect fragmentation to be done elsewhere.
-    buff = b''
+    pack = _LENGTH.pack
+    parts = []
     for b in bufflist:
-        b = struct.pack('!H', len(b)) + b
-        buff += b
+        parts.append(pack(len(b)) + b)
 
     # Arranged size,data,size,data....
-    return buff
+    return b''.join(parts)
 
 
 def unjoin_buffers(buff):
     # Returns a list of buffers that can each be converted with to_table
+    # These are memoryview slices of the packet, nothing gets copied
+    # Compact packets give frames instead, which only to_table and
+    # get_tabledef read
+    if buff[:2] == _COMPACT:
+        return _unjoin_compact(buff)
+
+    view = memoryview(buff)
+    unpack_from = _LENGTH.unpack_from
+    end = len(view)
+
     bufflist = []
     i = 0
-    while i < len(buff):
-        size = struct.unpack('!H', buff[:i + 2][i:])[0]
-        bufflist.append(buff[:i + 2 + size][i + 2:])
-        i = i + 2 + size
+    while i < end:
+        size = unpack_from(view, i)[0]
+        i += 2
+        bufflist.append(view[i:i + size])
+        i += size
 
     return bufflist
 
 
-def to_bytes(table):
-    tabledef = table._tabledef
+def _unjoin_compact(buff):
+    # Frames are decoded in place, so they come as (header, net_id, view)
+    # for to_table.  The view starts 2 bytes before the data, where the
+    # decoders expect the table ID and never read it.  Frames that carried
+    # the id in their header only hold the data and are decoded with
+    # _unpack_compact.
+    view = memoryview(buff)
+    frames = []
+    i = 2
+    end = len(view)
+    while i < end:
+        # Single byte varints are the usual case, skip the call for them
+        value = view[i]
+        if value < 0x80:
+            i += 1
+        else:
+            value, i = _read_varint(view, i)
+        size = value >> 2
+        flags = value & 3
+
+        table_id = view[i]
+        if table_id < 0x80:
+            i += 1
+        else:
+            table_id, i = _read_varint(view, i)
+        header = table_id | flags << 14
+
+        if flags or _TABLE_LIST[table_id]._compact_id is None:
+            frames.append((header, None, view[i - 2:i + size]))
+        else:
+            # IDs past 127 take two bytes, common enough to skip the call too
+            net_id = view[i]
+            if net_id < 0x80:
+                i += 1
+            elif view[i + 1] < 0x80:
+                net_id = net_id & 0x7F | view[i + 1] << 7
+                i += 2
+            else:
+                net_id, i = _read_varint(view, i)
+            frames.append((header, net_id, view[i:i + size]))
+
+        i += size
+
+    return frames
+
+
+def get_tabledef(buff):
+    # TableDef of a packed table, without decoding anything
+    if type(buff) is tuple:
+        return _TABLE_LIST[buff[0] & _ID_MASK]
+    return _TABLE_LIST[_TABLE_ID.unpack_from(buff)[0] & _ID_MASK]
+
+
+def is_compact(buff):
+    # True for packets from a PacketWriter in compact mode
+    return buff[:2] == _COMPACT
+
+
+def to_bytes(table, sparse=False):
+    """
+    sparse leaves out the fields that equal their default and sends a
+    bitmask of the ones that are present, to_table fills the rest back in.
+    Fields left at a default of None don't count as missing then.
+    """
+    if table._lazy:
+        table = table.materialize()
+
+    if sparse:
+        return _to_sparse(table._tabledef, table._values)
+
+    return table._tabledef._pack(table._values)
+
+
+def _to_sparse(tabledef, values):
+    # Compared encoded, so any value a codec accepts works, numpy arrays
+    # included
+    codecs = tabledef._codecs
+    defaults = tabledef._raw_defaults
+
+    raw = list(values)
+    mask = 0
+    bit = 1
+    for i in range(1, len(raw)):
+        value = raw[i]
+        if value is None:
+            if defaults[i] is not None:
+                mask |= bit
+        else:
+            codec = codecs[i]
+            if codec is not None:
+                value = raw[i] = codec.encode(value)
+            if defaults[i] is None or value != defaults[i]:
+                mask |= bit
+        bit <<= 1
+
+    if mask == tabledef._full_mask:
+        # Nothing to leave out, the mask would only add to it
+        return tabledef._pack(values)
+
+    st, fixed_slots, var_slots = tabledef._delta_layout(mask)
     data = []
-    json_data = []
+    for i in fixed_slots:
+        value = raw[i]
+        if value is None:
+            missing = tabledef._keys[i]
+            raise KeyError("Missing required field: {}".format(missing))
+        data.append(value)
+
+    buff = _TABLE_ID.pack(tabledef._id | _SPARSE)
+    buff += mask.to_bytes(tabledef._mask_size, 'big')
+    buff += st.pack(*data)
 
-    for key, value in list(table._data.items()):
-        d = value[0]
-        v = value[1]
+    if not len(var_slots):
+        return buff
 
-        if v is None:
+    for i in var_slots:
+        if raw[i] is None:
+            missing = tabledef._keys[i]
+            raise KeyError("Missing required field: {}".format(missing))
+    return buff + _var_tail(raw, var_slots)
+
+
+def to_delta_bytes(table, baselines):
+    """
+    Encodes table against the state last sent to one receiver.  Only the
+    fields that changed are sent, behind a bitmask.
+
+    baselines maps (table ID, component ID) to that state and is updated
+    here, so keep one dict per receiver.  The receiver has to pass its own
+    dict to to_table.  Deltas must go out reliably on a single channel so
+    the receiver always holds the same baseline.
+
+    Returns None if nothing changed.
+    """
+    tabledef = table._tabledef
+    raw = _raw(table)
+
+    id_slot = tabledef._id_slot
+    if id_slot is None:
+        raise KeyError("Delta tables need an id field")
+
+    key = (tabledef._id, raw[id_slot])
+    baseline = baselines.get(key, None)
+    baselines[key] = raw
+
+    if baseline is None:
+        # First state for this receiver
+        return _keyframe(tabledef, raw)
+
+    mask = 0
+    bit = 1
+    for i in range(1, len(raw)):
+        if raw[i] != baseline[i]:
+            mask |= bit
+        bit <<= 1
+
+    if not mask:
+        return None
+
+    # Always send the ID so the receiver can find its baseline
+    mask |= 1 << (id_slot - 1)
+    st, fixed_slots, var_slots = tabledef._delta_layout(mask)
+
+    buff = _TABLE_ID.pack(tabledef._id | _DELTA)
+    buff += mask.to_bytes(tabledef._mask_size, 'big')
+    buff += st.pack(*[raw[i] for i in fixed_slots])
+
+    if not len(var_slots):
+        if len(buff) >= tabledef._struct.size:
+            # Mask overhead made it bigger, a keyframe works just as well
+            return _keyframe(tabledef, raw)
+        return buff
+
+    return buff + _var_tail(raw, var_slots)
+
+
+def _keyframe(tabledef, raw):
+    # Sends everything and marks it as the baseline for following deltas
+    data = raw[:tabledef._var_slot]
+    data[0] |= _KEYFRAME
+    buff = tabledef._struct.pack(*data)
+    return buff + _var_tail(raw, tabledef._var_slots)
+
+
+def _raw(table):
+    # Table values with the converting and variable-length fields encoded,
+    # as they go on the wire
+    if table._lazy:
+        table = table.materialize()
+
+    return table._tabledef._encode_raw(table._values)
+
+
+def _missing(tabledef, values):
+    # Not values.index(None), that compares numpy arrays elementwise
+    for i in range(len(values)):
+        if values[i] is None:
+            key = tabledef._keys[i]
             raise KeyError("Missing required field: {}".format(key))
 
-        if d == 'json':
-            json_data.append([key, v])
+
+def _var_tail(raw, var_slots):
+    # Encoded variable-length fields in slot order, each as varint size +
+    # data
+    if not len(var_slots):
+        return b''
+
+    tail = []
+    for i in var_slots:
+        data = raw[i]
+        tail.append(_varint(len(data)))
+        tail.append(data)
+
+    return b''.join(tail)
+
+
+def _read_var(tabledef, values, buff, offset, var_slots, decode=True):
+    # Without decode the fields are stored encoded, as in raw values
+    codecs = tabledef._var_codecs
+    for i in var_slots:
+        size, offset = _read_varint(buff, offset)
+        end = offset + size
+        if decode:
+            values[i] = codecs[i].decode(buff[offset:end])
         else:
-            data.append(v)
+            values[i] = bytes(buff[offset:end])
+        offset = end
 
-    buff = struct.pack(tabledef._formatstring, tabledef._id, *data)
-    if len(json_data):
-        buff += bytes(json.dumps(json_data), 'UTF-8')
+    return offset
 
-    return buff
 
+def _varint(n):
+    if n < 0x80:
+        return _SMALL_VARINTS[n]
+    if n < 0x4000:
+        return (n & 0x7F | 0x80 | n >> 7 << 8).to_bytes(2, 'little')
 
-def to_table(buff):
+    data = bytearray()
+    while n >= 0x80:
+        data.append((n & 0x7F) | 0x80)
+        n >>= 7
+    data.append(n)
+    return bytes(data)
+
+
+def _read_varint(buff, offset):
+    # Returns the value and the offset after it
+    n = 0
+    shift = 0
+    while True:
+        b = buff[offset]
+        offset += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return n, offset
+        shift += 7
+
+
+def to_table(buff, baselines=None, lazy=False, pooled=False):
+    """
+    baselines is the receiver's dict for tables sent with to_delta_bytes,
+    it is required for those and ignored for everything else.
+
+    lazy returns a view that decodes each field the first time it is read.
+    It keeps a reference to buff, call materialize() on it before storing
+    it anywhere.  Delta and sparse tables are always decoded right away.
+
+    pooled takes lazy tables from the ones handed back with release()
+    instead of allocating new ones.
+    """
     # Read the first 2 bytes to determine table ID
-    table_id = struct.unpack('!H', buff[:2])[0]
+    # buff may be bytes, a memoryview from unjoin_buffers or a compact frame
+    net_id = None
+    if type(buff) is tuple:
+        header, net_id, buff = buff
+    else:
+        header = _TABLE_ID.unpack_from(buff)[0]
+    table_id = header & _ID_MASK
     try:
         tabledef = _TABLE_LIST[table_id]
     except IndexError as err:
@@ -80,31 +397,880 @@ def to_table(buff):
         err.args = err.args + (msg,)
         raise
 
-    size = struct.calcsize(tabledef._formatstring)
-    data = struct.unpack(tabledef._formatstring, buff[:size])
+    if net_id is not None:
+        # The data is missing its id, so the field offsets don't apply and
+        # there's nothing to decode lazily
+        table = object.__new__(tabledef._table_class)
+        table._values = tabledef._unpack_compact(buff, net_id)
+        return table
 
-    table = Table(tabledef)
+    if lazy and not header & (_DELTA | _KEYFRAME):
+        pool = tabledef._pool
+        if pooled and len(pool):
+            table = pool.pop()
+            table._values[:] = tabledef._undecoded
+        else:
+            table = object.__new__(tabledef._lazy_class)
+            table._values = list(tabledef._undecoded)
+        table._buff = buff
+        table._misses = 0
+        return table
 
-    i = 1  # table ID is still in here, so we skip
-    for key, value in list(tabledef._datatypes.items()):
-        d = value[0]
+    table = object.__new__(tabledef._table_class)
 
-        if d == 'json':
-            # Check for json at the end
-            continue
-        else:
-            v = data[i]
-            table.set(key, v)
+    if header & _SPARSE == _SPARSE:
+        table._values = _from_sparse(tabledef, buff)
+    elif header & _DELTA:
+        raw = _from_delta(tabledef, buff, baselines)
+        table._values = tabledef._decode_raw(raw)
+    elif header & _KEYFRAME:
+        if baselines is None:
+            raise ValueError("Delta tables need baselines to decode")
+
+        raw = tabledef._unpack_raw(buff)
+        baselines[(table_id, raw[tabledef._id_slot])] = raw
+        table._values = tabledef._decode_raw(raw)
+    else:
+        table._values = tabledef._unpack(buff)
+
+    return table
+
+
+def release(table):
+    """
+    Hands a table from to_table(lazy=True, pooled=True) back for reuse.
+    Nothing may use it afterwards.  Tables that were materialized are
+    left alone, the regular Table shares their values, so a handler keeps
+    a pooled table by calling materialize() like with any lazy table.
+    """
+    if not table._lazy or table._buff is None:
+        return
+
+    table._buff = None
+    tabledef = table._tabledef
+    pool = tabledef._pool
+    # Tables from before the TableDef changed don't fit anymore
+    if len(pool) < _POOL_SIZE and type(table) is tabledef._lazy_class:
+        pool.append(table)
 
+
+def _from_delta(tabledef, buff, baselines):
+    # Rebuilds the raw values of a delta from the stored baseline
+    if baselines is None:
+        raise ValueError("Delta tables need baselines to decode")
+
+    offset = 2 + tabledef._mask_size
+    mask = int.from_bytes(buff[2:offset], 'big')
+    st, fixed_slots, var_slots = tabledef._delta_layout(mask)
+    data = st.unpack_from(buff, offset)
+
+    net_id = data[fixed_slots.index(tabledef._id_slot)]
+    key = (tabledef._id, net_id)
+    try:
+        raw = baselines[key]
+    except KeyError as err:
+        msg = 'No baseline for {} {}'.format(tabledef._name, net_id)
+        err.args = err.args + (msg,)
+        raise
+
+    i = 0
+    for slot in fixed_slots:
+        raw[slot] = data[i]
         i += 1
 
-    if len(buff) > size:
-        # There is json
-        json_data = json.loads(bytes.decode(buff[size:], 'UTF-8'))
-        for key, value in json_data:
-            table.set(key, value)
+    if len(var_slots):
+        _read_var(tabledef, raw, buff, offset + st.size, var_slots, False)
 
-    return table
+    return raw
+
+
+def _from_sparse(tabledef, buff):
+    # Fields missing from the mask are left at their defaults
+    offset = 2 + tabledef._mask_size
+    mask = int.from_bytes(buff[2:offset], 'big')
+    st, fixed_slots, var_slots = tabledef._delta_layout(mask)
+    data = st.unpack_from(buff, offset)
+
+    if tabledef._copy_defaults:
+        values = copy.deepcopy(tabledef._defaults)
+    else:
+        values = list(tabledef._defaults)
+
+    fields = tabledef._fields
+    i = 0
+    for slot in fixed_slots:
+        codec = fields[slot][2]
+        if codec is None:
+            values[slot] = data[i]
+        else:
+            values[slot] = codec.decode(data[i])
+        i += 1
+
+    if len(var_slots):
+        _read_var(tabledef, values, buff, offset + st.size, var_slots)
+
+    return values
+
+
+class _Json:
+    def encode(self, value):
+        return bytes(json.dumps(value), 'UTF-8')
+
+    def decode(self, buff):
+        return json.loads(str(buff, 'UTF-8'))
+
+
+class _Str:
+    def encode(self, value):
+        return value.encode('UTF-8')
+
+    def decode(self, buff):
+        return str(buff, 'UTF-8')
+
+
+class _Bytes:
+    def encode(self, value):
+        return bytes(value)
+
+    def decode(self, buff):
+        return bytes(buff)
+
+
+class _Array:
+    """
+    Sequence of one numeric type, e.g. 'float[]', decodes to a list
+    """
+
+    def __init__(self, fmt):
+        self.format = fmt
+        self.itemsize = struct.calcsize('!' + fmt)
+
+    def encode(self, value):
+        return struct.pack('!{}{}'.format(len(value), self.format), *value)
+
+    def decode(self, buff):
+        count = len(buff) // self.itemsize
+        return list(struct.unpack('!{}{}'.format(count, self.format), buff))
+
+
+_VAR_TYPES['json'] = _Json()
+_VAR_TYPES['str'] = _Str()
+_VAR_TYPES['bytes'] = _Bytes()
+for _name, _fmt in list(_DATA_TYPES.items()):
+    _VAR_TYPES[_name + '[]'] = _Array(_fmt)
+del _name, _fmt
+
+
+class _Quantized:
+    """
+    Float spread evenly over [low, high] and sent as an unsigned integer.
+    Values outside the range are clamped.
+    """
+
+    def __init__(self, fmt, low, high):
+        if low is None or high is None:
+            raise ValueError("Quantized types need min and max")
+        if high <= low:
+            raise ValueError("Invalid range: {} to {}".format(low, high))
+
+        self.format = fmt
+        self.low = low
+        self.high = high
+        # An even number of steps keeps the middle exact, so 0.0 in a
+        # symmetric range doesn't drift, as in _Transform
+        self.steps = (1 << (8 * struct.calcsize('!' + fmt))) - 2
+        self.scale = self.steps / (high - low)
+        self.precision = (high - low) / self.steps
+
+    def encode(self, value):
+        i = int((value - self.low) * self.scale + 0.5)
+        if i < 0:
+            return 0
+        if i > self.steps:
+            return self.steps
+        return i
+
+    def decode(self, i):
+        return self.low + i * self.precision
+
+    # numpy versions, see TableDef.encode_many
+    dtype = 'f8'
+
+    def wire_dtype(self):
+        return '>' + _NUMPY_TYPES[self.format]
+
+    def encode_array(self, values):
+        i = numpy.floor((values - self.low) * self.scale + 0.5)
+        return numpy.clip(i, 0, self.steps)
+
+    def decode_array(self, raw):
+        return self.low + raw * self.precision
+
+
+class _Angle:
+    """
+    Angle in radians wrapped onto a uint16, decoded into [-pi, pi)
+    """
+
+    format = 'H'
+    turn = 2 * math.pi
+    scale = 65536 / (2 * math.pi)
+    precision = (2 * math.pi) / 65536
+
+    def encode(self, value):
+        # Wrap first, int() rounds towards zero
+        return int((value % self.turn) * self.scale + 0.5) & 0xFFFF
+
+    def decode(self, i):
+        if i >= 32768:
+            i -= 65536
+        return i * self.precision
+
+    dtype = 'f8'
+
+    def wire_dtype(self):
+        return '>u2'
+
+    def encode_array(self, values):
+        i = numpy.floor(values * self.scale + 0.5).astype(numpy.int64)
+        return i & 0xFFFF
+
+    def decode_array(self, raw):
+        i = raw.astype(numpy.int64)
+        i[i >= 32768] -= 65536
+        return i * self.precision
+
+
+def _fixed(fmt):
+    def factory(min=None, max=None, precision=None):
+        codec = _Quantized(fmt, min, max)
+        if precision is not None and codec.precision > precision:
+            warnings.warn("Precision {} not reachable in {} bytes".format(
+                precision, struct.calcsize(fmt)))
+        return codec
+    return factory
+
+
+def _quantized(min=None, max=None, precision=None):
+    # Picks the smallest integer that satisfies the requested precision
+    if precision is None or precision <= 0:
+        raise ValueError("quantized needs a positive precision")
+    if min is None or max is None:
+        raise ValueError("Quantized types need min and max")
+
+    steps = (max - min) / precision
+    for fmt in 'BHI':
+        if steps <= (1 << (8 * struct.calcsize(fmt))) - 1:
+            return _Quantized(fmt, min, max)
+
+    raise ValueError("Precision too fine: {}".format(precision))
+
+
+def _vector(count):
+    def factory(type='float'):
+        return _Vector(count, type)
+    return factory
+
+
+def _angle(min=None, max=None, precision=None):
+    if min is not None or max is not None:
+        raise ValueError("angle16 always covers a full turn")
+    return _Angle()
+
+
+class _Vector:
+    """
+    Fixed number of floats sent as one struct slice.  Values can be any
+    sequence, mathutils types included, and decode to tuples.  type picks
+    the element type: float, double or half.
+    """
+
+    def __init__(self, count, type='float'):
+        fmt = _DATA_TYPES.get(type, None)
+        if fmt not in ('f', 'd', 'e'):
+            raise ValueError("Invalid element type: {}".format(type))
+
+        st = struct.Struct('!{}{}'.format(count, fmt))
+        self._pack = st.pack
+        self._unpack = st.unpack
+        self.count = count
+        self.format = '{}s'.format(st.size)
+        self._numpy_type = _NUMPY_TYPES[fmt]
+
+    def encode(self, value):
+        return self._pack(*value)
+
+    def decode(self, buff):
+        return self._unpack(buff)
+
+    @property
+    def dtype(self):
+        return ('=' + self._numpy_type, (self.count,))
+
+    def wire_dtype(self):
+        return ('>' + self._numpy_type, (self.count,))
+
+    def encode_array(self, values):
+        return values
+
+    def decode_array(self, raw):
+        return raw
+
+
+class _Matrix(_Vector):
+    """
+    3x3 rotation matrix sent as a (w, x, y, z) quaternion.  Values are
+    rows, e.g. a mathutils.Matrix, and decode to a tuple of row tuples.
+    """
+
+    def __init__(self, type='float'):
+        _Vector.__init__(self, 4, type)
+
+    def encode(self, value):
+        to_quaternion = getattr(value, 'to_quaternion', None)
+        if to_quaternion is not None:
+            return self._pack(*to_quaternion())
+
+        (m00, m01, m02), (m10, m11, m12), (m20, m21, m22) = value
+        trace = m00 + m11 + m22
+        if trace > 0.0:
+            s = math.sqrt(trace + 1.0) * 2.0
+            quat = (0.25 * s, (m21 - m12) / s, (m02 - m20) / s,
+                    (m10 - m01) / s)
+        elif m00 > m11 and m00 > m22:
+            s = math.sqrt(m00 - m11 - m22 + 1.0) * 2.0
+            quat = ((m21 - m12) / s, 0.25 * s, (m01 + m10) / s,
+                    (m02 + m20) / s)
+        elif m11 > m22:
+            s = math.sqrt(m11 - m00 - m22 + 1.0) * 2.0
+            quat = ((m02 - m20) / s, (m01 + m10) / s, 0.25 * s,
+                    (m12 + m21) / s)
+        else:
+            s = math.sqrt(m22 - m00 - m11 + 1.0) * 2.0
+            quat = ((m10 - m01) / s, (m02 + m20) / s, (m12 + m21) / s,
+                    0.25 * s)
+
+        return self._pack(*quat)
+
+    def decode(self, buff):
+        w, x, y, z = self._unpack(buff)
+        return ((1.0 - 2.0 * (y * y + z * z), 2.0 * (x * y - w * z),
+                 2.0 * (x * z + w * y)),
+                (2.0 * (x * y + w * z), 1.0 - 2.0 * (x * x + z * z),
+                 2.0 * (y * z - w * x)),
+                (2.0 * (x * z - w * y), 2.0 * (y * z + w * x),
+                 1.0 - 2.0 * (x * x + y * y)))
+
+    @property
+    def dtype(self):
+        return ('=' + self._numpy_type, (3, 3))
+
+    def encode_array(self, values):
+        m = numpy.asarray(values, numpy.float64)
+        m00, m01, m02 = m[:, 0, 0], m[:, 0, 1], m[:, 0, 2]
+        m10, m11, m12 = m[:, 1, 0], m[:, 1, 1], m[:, 1, 2]
+        m20, m21, m22 = m[:, 2, 0], m[:, 2, 1], m[:, 2, 2]
+
+        # Same four cases as encode, case k has component k as the large
+        # one and the other three from parts, in order
+        cases = (
+            (m00 + m11 + m22, (m21 - m12, m02 - m20, m10 - m01)),
+            (m00 - m11 - m22, (m21 - m12, m01 + m10, m02 + m20)),
+            (m11 - m00 - m22, (m02 - m20, m01 + m10, m12 + m21)),
+            (m22 - m00 - m11, (m10 - m01, m02 + m20, m12 + m21)),
+        )
+        first = cases[0][0] > 0.0
+        second = ~first & (m00 > m11) & (m00 > m22)
+        third = ~first & ~second & (m11 > m22)
+        fourth = ~(first | second | third)
+
+        quat = numpy.empty((len(m), 4))
+        for k, rows in enumerate((first, second, third, fourth)):
+            trace, parts = cases[k]
+            s = numpy.sqrt(trace[rows] + 1.0) * 2.0
+            others = [j for j in range(4) if j != k]
+            quat[rows, k] = 0.25 * s
+            for j, part in zip(others, parts):
+                quat[rows, j] = part[rows] / s
+
+        return quat
+
+    def decode_array(self, raw):
+        q = raw.astype(numpy.float64)
+        w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+
+        m = numpy.empty((len(q), 3, 3))
+        m[:, 0, 0] = 1.0 - 2.0 * (y * y + z * z)
+        m[:, 0, 1] = 2.0 * (x * y - w * z)
+        m[:, 0, 2] = 2.0 * (x * z + w * y)
+        m[:, 1, 0] = 2.0 * (x * y + w * z)
+        m[:, 1, 1] = 1.0 - 2.0 * (x * x + z * z)
+        m[:, 1, 2] = 2.0 * (y * z - w * x)
+        m[:, 2, 0] = 2.0 * (x * z - w * y)
+        m[:, 2, 1] = 2.0 * (y * z + w * x)
+        m[:, 2, 2] = 1.0 - 2.0 * (x * x + y * y)
+        return m
+
+
+class _Transform:
+    """
+    Position, rotation and optionally linear/angular velocity bit-packed
+    into one fixed-size field.  The value is (pos, rot) or
+    (pos, rot, lv, av), and decodes to tuples in the same order.
+
+    bounds: position range, defaults to WORLD_BOUNDS
+    pos_bits: bits per position axis
+    rot_bits: bits per quaternion component, using smallest-three
+    velocity: also send linear and angular velocity
+    vel_max, vel_bits: velocity range (+/-) and bits per axis
+    """
+
+    # Range of the three smallest components of a unit quaternion
+    _ROT_RANGE = 1.0 / math.sqrt(2.0)
+
+    def __init__(self, bounds=None, pos_bits=16, rot_bits=9, velocity=False,
+                 vel_max=32.0, vel_bits=8):
+        if bounds is None:
+            bounds = WORLD_BOUNDS
+
+        # Every range uses an even number of steps, so the middle of it
+        # stays exact.  That's 0.0 for symmetric bounds, rotations and
+        # velocities, otherwise resting objects would drift.
+        low, high = bounds
+        self.low = tuple(low)
+        self.pos_bits = pos_bits
+        self.pos_mask = (1 << pos_bits) - 1
+        self.pos_max = self.pos_mask - 1
+        self.pos_scale = tuple(self.pos_max / (high[i] - low[i])
+                               for i in range(3))
+
+        self.rot_bits = rot_bits
+        self.rot_mask = (1 << rot_bits) - 1
+        self.rot_max = self.rot_mask - 1
+        self.rot_scale = self.rot_max / (2.0 * self._ROT_RANGE)
+
+        self.velocity = velocity
+        self.vel_max = vel_max
+        self.vel_bits = vel_bits
+        self.vel_mask = (1 << vel_bits) - 1
+        self.vel_steps = self.vel_mask - 1
+        self.vel_scale = self.vel_steps / (2.0 * vel_max)
+
+        bits = 3 * pos_bits + 2 + 3 * rot_bits
+        if velocity:
+            bits += 6 * vel_bits
+
+        self.size = (bits + 7) // 8
+        self.pad = self.size * 8 - bits
+        self.format = '{}s'.format(self.size)
+
+    def _pack_vel(self, n, vec):
+        bits = self.vel_bits
+        steps = self.vel_steps
+        for i in range(3):
+            v = int((vec[i] + self.vel_max) * self.vel_scale + 0.5)
+            if v < 0:
+                v = 0
+            elif v > steps:
+                v = steps
+            n = (n << bits) | v
+        return n
+
+    def _unpack_vel(self, n):
+        bits = self.vel_bits
+        mask = self.vel_mask
+        middle = self.vel_steps // 2
+        step = 1.0 / self.vel_scale
+        vec = [0.0, 0.0, 0.0]
+        for i in (2, 1, 0):
+            vec[i] = ((n & mask) - middle) * step
+            n >>= bits
+        return n, tuple(vec)
+
+    def encode(self, value):
+        pos = value[0]
+        rot = value[1]
+
+        n = 0
+        bits = self.pos_bits
+        maximum = self.pos_max
+        for i in range(3):
+            v = int((pos[i] - self.low[i]) * self.pos_scale[i] + 0.5)
+            if v < 0:
+                v = 0
+            elif v > maximum:
+                v = maximum
+            n = (n << bits) | v
+
+        # Smallest-three: drop the largest component and send its index,
+        # it is rebuilt from the unit length.  q and -q are the same
+        # rotation, so flip the sign to keep the dropped one positive.
+        largest = 0
+        for i in range(1, 4):
+            if abs(rot[i]) > abs(rot[largest]):
+                largest = i
+
+        length = math.sqrt(rot[0] * rot[0] + rot[1] * rot[1] +
+                           rot[2] * rot[2] + rot[3] * rot[3])
+        if length == 0.0:
+            length = 1.0
+        if rot[largest] < 0.0:
+            length = -length
+
+        n = (n << 2) | largest
+        bits = self.rot_bits
+        maximum = self.rot_max
+        for i in range(4):
+            if i == largest:
+                continue
+            v = int((rot[i] / length + self._ROT_RANGE) * self.rot_scale + 0.5)
+            if v < 0:
+                v = 0
+            elif v > maximum:
+                v = maximum
+            n = (n << bits) | v
+
+        if self.velocity:
+            n = self._pack_vel(n, value[2])
+            n = self._pack_vel(n, value[3])
+
+        return (n << self.pad).to_bytes(self.size, 'big')
+
+    def decode(self, buff):
+        n = int.from_bytes(buff, 'big') >> self.pad
+
+        if self.velocity:
+            n, av = self._unpack_vel(n)
+            n, lv = self._unpack_vel(n)
+
+        bits = self.rot_bits
+        mask = self.rot_mask
+        middle = self.rot_max // 2
+        step = 1.0 / self.rot_scale
+        rot = [0.0, 0.0, 0.0, 0.0]
+        smallest = []
+        for i in range(3):
+            # Counted from the middle, so it decodes to exactly 0.0
+            smallest.append(((n & mask) - middle) * step)
+            n >>= bits
+
+        largest = n & 3
+        n >>= 2
+
+        # Components came out last first
+        total = 0.0
+        j = 0
+        for i in (3, 2, 1, 0):
+            if i == largest:
+                continue
+            v = smallest[j]
+            rot[i] = v
+            total += v * v
+            j += 1
+
+        rot[largest] = math.sqrt(max(0.0, 1.0 - total))
+
+        bits = self.pos_bits
+        mask = self.pos_mask
+        pos = [0.0, 0.0, 0.0]
+        for i in (2, 1, 0):
+            pos[i] = self.low[i] + (n & mask) / self.pos_scale[i]
+            n >>= bits
+
+        if self.velocity:
+            return tuple(pos), tuple(rot), lv, av
+        return tuple(pos), tuple(rot)
+
+    # numpy versions, see TableDef.encode_many
+    # The components are laid out as a bit matrix, one row per table, and
+    # packed with numpy.packbits.  Same bit order as encode.
+
+    @property
+    def dtype(self):
+        dtype = [('pos', 'f8', (3,)), ('rot', 'f8', (4,))]
+        if self.velocity:
+            dtype += [('lv', 'f8', (3,)), ('av', 'f8', (3,))]
+        return dtype
+
+    def wire_dtype(self):
+        return ('u1', (self.size,))
+
+    # Indices of the three smallest components, by largest component
+    _SMALLEST = ((1, 2, 3), (0, 2, 3), (0, 1, 3), (0, 1, 2))
+
+    def _quantize_array(self, values, offset, scale, maximum):
+        i = numpy.floor((values + offset) * scale + 0.5)
+        return numpy.clip(i, 0, maximum).astype(numpy.int64)
+
+    def encode_array(self, values):
+        count = len(values)
+        rows = numpy.arange(count)
+        parts = []
+
+        pos = values['pos']
+        for i in range(3):
+            parts.append((self._quantize_array(
+                pos[:, i], -self.low[i], self.pos_scale[i], self.pos_max),
+                self.pos_bits))
+
+        rot = values['rot']
+        largest = numpy.argmax(numpy.abs(rot), axis=1)
+        length = numpy.sqrt((rot * rot).sum(axis=1))
+        length[length == 0.0] = 1.0
+        length[rot[rows, largest] < 0.0] *= -1.0
+
+        smallest = numpy.array(self._SMALLEST)[largest]
+        rot = rot[rows[:, None], smallest] / length[:, None]
+        parts.append((largest, 2))
+        for i in range(3):
+            parts.append((self._quantize_array(
+                rot[:, i], self._ROT_RANGE, self.rot_scale, self.rot_max),
+                self.rot_bits))
+
+        if self.velocity:
+            for name in ('lv', 'av'):
+                vec = values[name]
+                for i in range(3):
+                    parts.append((self._quantize_array(
+                        vec[:, i], self.vel_max, self.vel_scale,
+                        self.vel_steps), self.vel_bits))
+
+        columns = []
+        for value, bits in parts:
+            shifts = numpy.arange(bits - 1, -1, -1)
+            columns.append((value[:, None] >> shifts) & 1)
+        columns.append(numpy.zeros((count, self.pad), numpy.int64))
+
+        bits = numpy.hstack(columns).astype(numpy.uint8)
+        return numpy.packbits(bits, axis=1)
+
+    def decode_array(self, raw):
+        bits = numpy.unpackbits(raw.astype(numpy.uint8), axis=1)
+        count = len(bits)
+        rows = numpy.arange(count)
+        out = numpy.zeros(count, self.dtype)
+        column = [0]
+
+        def take(size):
+            start = column[0]
+            column[0] += size
+            weights = 1 << numpy.arange(size - 1, -1, -1)
+            return bits[:, start:start + size].dot(weights)
+
+        pos = out['pos']
+        for i in range(3):
+            pos[:, i] = self.low[i] + take(self.pos_bits) / self.pos_scale[i]
+
+        largest = take(2)
+        smallest = numpy.empty((count, 3))
+        for i in range(3):
+            smallest[:, i] = ((take(self.rot_bits) - self.rot_max // 2) /
+                              self.rot_scale)
+
+        rot = out['rot']
+        rot[rows[:, None], numpy.array(self._SMALLEST)[largest]] = smallest
+        total = (smallest * smallest).sum(axis=1)
+        rot[rows, largest] = numpy.sqrt(numpy.maximum(0.0, 1.0 - total))
+
+        if self.velocity:
+            for name in ('lv', 'av'):
+                vec = out[name]
+                for i in range(3):
+                    vec[:, i] = ((take(self.vel_bits) - self.vel_steps // 2) /
+                                 self.vel_scale)
+
+        return out
+
+
+_FIELD_TYPES['fixed8'] = _fixed('B')
+_FIELD_TYPES['fixed16'] = _fixed('H')
+_FIELD_TYPES['quantized'] = _quantized
+_FIELD_TYPES['angle16'] = _angle
+_FIELD_TYPES['transform'] = _Transform
+_FIELD_TYPES['vec2'] = _vector(2)
+_FIELD_TYPES['vec3'] = _vector(3)
+_FIELD_TYPES['quat'] = _vector(4)
+_FIELD_TYPES['mat3'] = _Matrix
+
+
+class PacketWriter:
+    """
+    Reusable output buffer using the same size,data,size,data... layout as
+    join_buffers.  Writes append to a bytearray, and finish() hands back
+    the bytearray itself so it can go to ENetWrapper.send without another
+    copy.  clear() starts a new one, enet has already copied the old one.
+
+    compact packets start with a marker and frame each table as
+        varint size << 2 | delta bits, varint table ID, [varint id,] data
+    Plain tables with a uint16 id field move it into the frame, so small
+    tables and IDs take one byte each instead of two.  unjoin_buffers reads
+    both layouts, but older versions don't, so the hosts only use it when
+    the other end asked for it.  Only change compact while empty.
+    """
+
+    def __init__(self, compact=False):
+        self._buff = bytearray()
+        self.compact = compact
+
+    def __len__(self):
+        return len(self._buff)
+
+    def write(self, buff):
+        # Queues an already packed buffer, e.g. from to_bytes
+        if self.compact:
+            self._write_compact(buff)
+            return
+
+        out = self._buff
+        out += _LENGTH.pack(len(buff))
+        out += buff
+
+    def write_table(self, table, sparse=False):
+        if table._lazy:
+            table = table.materialize()
+
+        if sparse:
+            self.write(_to_sparse(table._tabledef, table._values))
+        elif self.compact:
+            out = self._buff
+            if not out:
+                out += _COMPACT
+            out += table._tabledef._pack_compact(table._values)
+        else:
+            self._buff += table._tabledef._pack_joined(table._values)
+
+    def write_joined(self, buff):
+        # Appends buffers that are already joined, e.g. from encode_many
+        if self.compact:
+            for b in unjoin_buffers(buff):
+                self._write_compact(b)
+            return
+
+        self._buff += buff
+
+    def _write_compact(self, buff):
+        view = memoryview(buff)
+        header = _TABLE_ID.unpack_from(view)[0]
+        flags = header >> 14
+        table_id = header & _ID_MASK
+
+        id_offset = None
+        if not flags:
+            id_offset = _TABLE_LIST[table_id]._compact_id
+
+        out = self._buff
+        if not out:
+            out += _COMPACT
+
+        if id_offset is None:
+            out += _varint((len(view) - 2) << 2 | flags)
+            out += _varint(table_id)
+            out += view[2:]
+        else:
+            net_id = _TABLE_ID.unpack_from(view, id_offset)[0]
+            out += _varint((len(view) - 4) << 2)
+            out += _varint(table_id)
+            out += _varint(net_id)
+            out += view[2:id_offset]
+            out += view[id_offset + 2:]
+
+    def finish(self):
+        return self._buff
+
+    def clear(self):
+        self._buff = bytearray()
+
+
+class PacketCompressor:
+    """
+    Optional stage between a PacketWriter and ENetWrapper.send, pass one
+    to the hosts.  Packets of at least threshold bytes are deflated with a
+    preset dictionary and only sent that way if they got smaller.  Both
+    ends need the same dictionary, see train_dictionary.
+
+    record keeps up to that many outgoing packets in samples, to train a
+    dictionary from real traffic.
+
+    max_size limits what a packet may inflate to, decompress returns None
+    for anything bigger so a peer can't exhaust memory with a small one.
+    """
+
+    def __init__(self, dictionary=b'', threshold=128, level=9, record=0,
+                 max_size=1 << 20):
+        self.dictionary = bytes(dictionary)
+        self.threshold = threshold
+        self.level = level
+        self.record = record
+        self.max_size = max_size
+        self.samples = []
+
+    def compress(self, buff):
+        if len(self.samples) < self.record:
+            self.samples.append(bytes(buff))
+
+        if len(buff) < self.threshold:
+            return buff
+
+        # Raw deflate, ENet already checksums packets
+        if len(self.dictionary):
+            obj = zlib.compressobj(self.level, zlib.DEFLATED, -15, 9,
+                                   zlib.Z_DEFAULT_STRATEGY, self.dictionary)
+        else:
+            obj = zlib.compressobj(self.level, zlib.DEFLATED, -15, 9)
+
+        data = obj.compress(buff) + obj.flush()
+        if len(data) + len(_COMPRESSED) >= len(buff):
+            return buff
+
+        return _COMPRESSED + data
+
+    def decompress(self, buff):
+        if buff[:2] != _COMPRESSED:
+            return buff
+
+        if len(self.dictionary):
+            obj = zlib.decompressobj(-15, self.dictionary)
+        else:
+            obj = zlib.decompressobj(-15)
+
+        data = obj.decompress(buff[2:], self.max_size)
+        if obj.unconsumed_tail:
+            # Would inflate past max_size
+            return None
+
+        return data + obj.flush()
+
+    def train(self, size=4096):
+        # Builds the dictionary from the recorded samples
+        self.dictionary = train_dictionary(self.samples, size)
+        return self.dictionary
+
+
+def train_dictionary(samples, size=4096, segment=8):
+    """
+    Builds a preset dictionary from sample packets or table buffers.  Byte
+    runs that show up in many samples are collected, the most common ones
+    last since deflate reaches the end of the dictionary most cheaply.
+    Save the result and hand it to PacketCompressor on both ends.
+    """
+    counts = collections.Counter()
+    for sample in samples:
+        sample = bytes(sample)
+        seen = set()
+        for i in range(len(sample) - segment + 1):
+            seen.add(sample[i:i + segment])
+        counts.update(seen)
+
+    chosen = []
+    total = 0
+    for data, count in counts.most_common():
+        if count < 2 or total + segment > size:
+            break
+        chosen.append(data)
+        total += segment
+
+    chosen.reverse()
+    return b''.join(chosen)
 
 
 class TableDef:
@@ -115,41 +1281,251 @@ class TableDef:
         self._name = name
         self._id = len(_TABLE_LIST)
 
+        if self._id > _ID_MASK:
+            raise ValueError("Too many tables")
+
         if template is None:
             self._datatypes = collections.OrderedDict()
-            self._formatstring = '!H'
         else:
             if type(template) is str:
                 template = _TABLES[template]
 
             self._datatypes = copy.deepcopy(template._datatypes)
-            self._formatstring = template._formatstring
+
+        self._compile()
 
         _TABLES[name] = self
         _TABLE_LIST.append(self)
 
-    def define(self, datatype, key, default=None):
+    def define(self, datatype, key, default=None, **options):
+        """
+        Options configure the converting types:
+        fixed8 and fixed16 spread min..max over 1 or 2 bytes, quantized
+        picks the smallest size that meets precision.  angle16 takes
+        radians and needs no options.  See _Transform for transform.
+        vec2, vec3, quat and mat3 (sent as a quaternion) take one sequence
+        per field, type sets the element type.
+        """
         d = self._datatypes
 
         if d.get(key, None) is not None:
             warnings.warn("Key already defined: {}".format(key))
 
-        if _DATA_TYPES.get(datatype, None) is None:
+        factory = _FIELD_TYPES.get(datatype, None)
+        if factory is not None:
+            codec = factory(**options)
+            d[key] = [codec.format, default, codec]
+        elif _VAR_TYPES.get(datatype, None) is not None:
+            if len(options):
+                raise ValueError("{} does not take options".format(datatype))
+            d[key] = [None, default, _VAR_TYPES[datatype]]
+        elif _DATA_TYPES.get(datatype, None) is None:
             raise KeyError("Invalid datatype: {}".format(datatype))
+        elif len(options):
+            raise ValueError("{} does not take options".format(datatype))
+        else:
+            d[key] = [_DATA_TYPES[datatype], default, None]
 
-        d[key] = [_DATA_TYPES[datatype], default]
         self._datatypes = collections.OrderedDict(sorted(list(d.items()),
                 key=lambda t: t[0]))
 
-        # Rebuild the format string
+        self._compile()
+
+    def _compile(self):
+        # Rebuild the format string and the precompiled codec
+        # Fixed-size fields are packed with a single cached struct.Struct in
+        # key order, see _generate_codec for the functions built around it.
         formatstring = '!H'
+        fixed_keys = []
+        var_keys = []
 
-        for value in list(self._datatypes.values()):
+        # Per-field struct, offset and codec, by slot
+        fields = [None]
+
+        for key, value in self._datatypes.items():
             d = value[0]
-            if d != 'json':  # json is appened to the end of the buffer
+            if d is None:  # Variable-length, appended to the end
+                var_keys.append(key)
+            else:
+                fields.append((struct.Struct('!' + d),
+                               struct.calcsize(formatstring), value[2]))
                 formatstring += d
+                fixed_keys.append(key)
 
         self._formatstring = formatstring
+        self._struct = struct.Struct(formatstring)
+        self._fixed_keys = tuple(fixed_keys)
+        self._var_keys = tuple(var_keys)
+
+        # Table values live in a flat list: table ID, fixed fields, then the
+        # variable-length ones
+        keys = ('',) + self._fixed_keys + self._var_keys
+        self._keys = keys
+        self._index = {key: i for i, key in enumerate(keys) if i}
+        self._var_slot = len(fixed_keys) + 1
+        self._var_slots = tuple(range(self._var_slot, len(keys)))
+
+        # Indexed by slot, only the variable-length entries are used
+        self._var_codecs = [None] * self._var_slot
+        self._var_codecs.extend(self._datatypes[key][2] for key in var_keys)
+        self._id_slot = self._index.get('id', None)
+
+        # Offset of a plain uint16 id, which compact packets send as a varint
+        self._compact_id = None
+        if self._id_slot is not None and self._id_slot < self._var_slot:
+            st, offset, codec = fields[self._id_slot]
+            if st.format in ('!H', b'!H') and codec is None:
+                self._compact_id = offset
+
+        # Delta and sparse tables send a bitmask of the fields they carry,
+        # one bit per slot after the table ID.  Layouts are built as masks
+        # show up.
+        self._mask_size = (len(keys) + 6) // 8
+        self._full_mask = (1 << (len(keys) - 1)) - 1
+        self._delta_layouts = {}
+        self._defaults = [self._id] + [self._datatypes[key][1]
+                                       for key in keys[1:]]
+
+        # Codec by slot, and the defaults as they go on the wire for
+        # comparing sparse tables
+        self._codecs = [None] + [self._datatypes[key][2] for key in keys[1:]]
+        self._raw_defaults = [self._id]
+        for i in range(1, len(keys)):
+            value = self._defaults[i]
+            codec = self._codecs[i]
+            if value is not None and codec is not None:
+                value = codec.encode(value)
+            self._raw_defaults.append(value)
+
+        # Mutable defaults (json containers) still need a private copy
+        self._copy_defaults = any(type(v) in (list, dict)
+                                  for v in self._defaults)
+
+        self._fields = fields
+        self._undecoded = [self._id] + [_UNDECODED] * (len(keys) - 1)
+
+        # Each TableDef gets its own slotted Table class, so building a table
+        # is a single list copy instead of a deepcopy of the definition
+        attrs = {
+            '__slots__': (),
+            '_tabledef': self,
+            '_index': self._index,
+            '_defaults': self._defaults,
+            '_copy_defaults': self._copy_defaults,
+        }
+        self._table_class = type(self._name, (Table,), attrs)
+        self._lazy_class = type(self._name, (_LazyTable,), attrs)
+        self._pool = []
+
+        _generate_codec(self)
+
+    def _delta_layout(self, mask):
+        layout = self._delta_layouts.get(mask, None)
+        if layout is None:
+            formatstring = '!'
+            fixed_slots = []
+            var_slots = []
+            for i in range(1, len(self._keys)):
+                if mask & (1 << (i - 1)):
+                    if i < self._var_slot:
+                        formatstring += self._datatypes[self._keys[i]][0]
+                        fixed_slots.append(i)
+                    else:
+                        var_slots.append(i)
+
+            layout = (struct.Struct(formatstring), tuple(fixed_slots),
+                      tuple(var_slots))
+            self._delta_layouts[mask] = layout
+
+        return layout
+
+    def to_dtype(self):
+        """
+        numpy structured dtype with one field per fixed-size key, holding
+        values the way Table does.  Quantized fields are float64, transform
+        fields have pos, rot, lv and av sub-arrays.  Variable-length fields
+        can't be part of it.
+        """
+        if numpy is None:
+            raise ImportError("numpy is required for bulk encoding")
+
+        dtype = []
+        for i in range(1, self._var_slot):
+            codec = self._fields[i][2]
+            if codec is None:
+                fmt = self._datatypes[self._keys[i]][0]
+                dtype.append((self._keys[i], '=' + _NUMPY_TYPES[fmt]))
+            else:
+                dtype.append((self._keys[i], codec.dtype))
+
+        return numpy.dtype(dtype)
+
+    def _wire_dtype(self):
+        # One row as join_buffers lays it out: size, table ID, fields
+        dtype = [('_size', '>u2'), ('_table', '>u2')]
+        for i in range(1, self._var_slot):
+            codec = self._fields[i][2]
+            if codec is None:
+                fmt = self._datatypes[self._keys[i]][0]
+                dtype.append((self._keys[i], '>' + _NUMPY_TYPES[fmt]))
+            else:
+                dtype.append((self._keys[i], codec.wire_dtype()))
+
+        return numpy.dtype(dtype)
+
+    def encode_many(self, array):
+        """
+        Packs every row of a structured array with the to_dtype layout in
+        one vectorized pass.  Returns the same bytes join_buffers would for
+        the rows packed one by one, ready for PacketWriter.write_joined.
+        """
+        if numpy is None:
+            raise ImportError("numpy is required for bulk encoding")
+
+        if len(self._var_slots):
+            raise TypeError("Variable-length fields can't be bulk encoded")
+
+        wire = numpy.empty(len(array), self._wire_dtype())
+        wire['_size'] = self._struct.size
+        wire['_table'] = self._id
+
+        for i in range(1, self._var_slot):
+            key = self._keys[i]
+            codec = self._fields[i][2]
+            if codec is None:
+                wire[key] = array[key]
+            else:
+                wire[key] = codec.encode_array(array[key])
+
+        return wire.tobytes()
+
+    def decode_many(self, buff):
+        """
+        Reverse of encode_many.  buff must only hold rows of this table,
+        as from encode_many.  Returns a structured array with the to_dtype
+        layout.
+        """
+        if numpy is None:
+            raise ImportError("numpy is required for bulk encoding")
+
+        if len(self._var_slots):
+            raise TypeError("Variable-length fields can't be bulk decoded")
+
+        wire = numpy.frombuffer(buff, self._wire_dtype())
+        if (wire['_size'] != self._struct.size).any() or \
+                (wire['_table'] != self._id).any():
+            raise ValueError("Buffer holds rows of other tables")
+
+        array = numpy.empty(len(wire), self.to_dtype())
+        for i in range(1, self._var_slot):
+            key = self._keys[i]
+            codec = self._fields[i][2]
+            if codec is None:
+                array[key] = wire[key]
+            else:
+                array[key] = codec.decode_array(wire[key])
+
+        return array
 
     def tableName(self):
         return self._name
@@ -158,28 +1534,221 @@ class TableDef:
         return self._id
 
 
+def _generate_codec(tabledef):
+    """
+    Writes and compiles the encode/decode functions for one TableDef, the
+    same way namedtuple builds its classes.  Every field is unrolled into
+    straight-line code around a single struct call, so there are no loops
+    or per-field lookups left at runtime.  The source ends up in
+    tabledef._source for debugging.
+
+    Functions taking or returning values use the table's value list:
+        _pack(values) -> bytes
+        _pack_joined(values) -> length and bytes, as join_buffers lays out
+        _pack_compact(values) -> a frame for compact packets
+        _unpack_compact(buff, net_id) -> values of a frame without its id
+        _encode_raw(values) -> values as they go on the wire
+        _unpack(buff) -> values
+        _unpack_raw(buff) -> wire values
+        _decode_raw(raw) -> values
+    """
+    st = tabledef._struct
+    var_slot = tabledef._var_slot
+    count = len(tabledef._keys)
+    fixed = range(1, var_slot)
+    var = range(var_slot, count)
+
+    namespace = {
+        'tabledef': tabledef,
+        'ID': tabledef._id,
+        'SIZE': st.size,
+        'missing': _missing,
+        'struct': struct,
+        'varint': _varint,
+        'read_varint': _read_varint,
+        'st_pack': st.pack,
+        'joined_pack': struct.Struct(
+            '!H' + tabledef._formatstring[1:]).pack,
+        'st_unpack_from': st.unpack_from,
+    }
+
+    # Slot 0 is the table ID, it is always the constant ID
+    names = ['_'] + ['v{}'.format(i) for i in range(1, count)]
+    unpack_all = '    {}, = values'.format(', '.join(names))
+    unpack_fixed = '{}, = st_unpack_from(buff)'.format(
+        ', '.join(names[:var_slot]))
+
+    encoded = ['ID']
+    decoded = ['ID']
+    for i in fixed:
+        codec = tabledef._fields[i][2]
+        if codec is None:
+            encoded.append(names[i])
+            decoded.append(names[i])
+        else:
+            namespace['enc{}'.format(i)] = codec.encode
+            namespace['dec{}'.format(i)] = codec.decode
+            encoded.append('enc{}({})'.format(i, names[i]))
+            decoded.append('dec{}({})'.format(i, names[i]))
+
+    tail = []
+    for i in var:
+        codec = tabledef._var_codecs[i]
+        namespace['enc{}'.format(i)] = codec.encode
+        namespace['dec{}'.format(i)] = codec.decode
+        tail.append('    e{0} = enc{0}({1})'.format(i, names[i]))
+    parts = ', '.join('varint(len(e{0})), e{0}'.format(i) for i in var)
+    if len(var):
+        tail.append("    tail = b''.join(({}))".format(parts))
+
+    fixed_args = ', '.join(encoded)
+    placeholders = ['None'] * len(var)
+    # Checked per slot, "None in values" would compare numpy arrays
+    check = []
+    if count > 1:
+        check = [
+            '    if {}:'.format(' or '.join(
+                '{} is None'.format(name) for name in names[1:])),
+            '        missing(tabledef, values)',
+        ]
+
+    lines = ['def _pack(values):', unpack_all] + check + tail
+    if len(var):
+        lines.append('    return st_pack({}) + tail'.format(fixed_args))
+    else:
+        lines.append('    return st_pack({})'.format(fixed_args))
+
+    # The length goes into the same struct call
+    lines += ['', 'def _pack_joined(values):', unpack_all] + check + tail
+    if len(var):
+        lines.append('    return joined_pack(SIZE + len(tail), {}) + tail'
+                     .format(fixed_args))
+    else:
+        lines.append('    return joined_pack(SIZE, {})'.format(fixed_args))
+
+    # Compact frames leave out the table ID, and the id field too when it
+    # is a plain uint16, which goes in the frame header instead
+    id_slot = None
+    if tabledef._compact_id is not None:
+        id_slot = tabledef._id_slot
+    body = [i for i in fixed if i != id_slot]
+    body_st = struct.Struct('!' + ''.join(
+        tabledef._datatypes[tabledef._keys[i]][0] for i in body))
+    namespace['BODY_SIZE'] = body_st.size
+    namespace['body_pack'] = body_st.pack
+    namespace['body_unpack_from'] = body_st.unpack_from
+    namespace['TABLE_ID'] = _varint(tabledef._id)
+    namespace['FRAME'] = _varint(body_st.size << 2) + _varint(tabledef._id)
+
+    body_args = ', '.join(encoded[i] for i in body)
+    lines += ['', 'def _pack_compact(values):', unpack_all] + check + tail
+    if len(var):
+        head = 'varint((BODY_SIZE + len(tail)) << 2) + TABLE_ID'
+        suffix = ' + tail'
+    else:
+        head = 'FRAME'
+        suffix = ''
+    if id_slot is not None:
+        net_id = names[id_slot]
+        lines += [
+            '    if not 0 <= {} <= 0xFFFF:'.format(net_id),
+            "        raise struct.error('id out of range: {{}}'.format({}))"
+            .format(net_id),
+        ]
+        head += ' + varint({})'.format(net_id)
+    lines.append('    return {} + body_pack({}){}'.format(head, body_args,
+                                                       suffix))
+
+    if id_slot is not None:
+        lines += ['', 'def _unpack_compact(buff, {}):'.format(names[id_slot])]
+        if len(body):
+            lines.append('    {}, = body_unpack_from(buff)'.format(
+                ', '.join(names[i] for i in body)))
+        items = decoded[:var_slot] + placeholders
+        lines.append('    values = [{}]'.format(', '.join(items)))
+        if len(var):
+            lines.append('    offset = BODY_SIZE')
+        for i in var:
+            lines += [
+                '    size, offset = read_varint(buff, offset)',
+                '    end = offset + size',
+                '    values[{}] = dec{}(buff[offset:end])'.format(i, i),
+                '    offset = end',
+            ]
+        lines.append('    return values')
+
+    # Variable-length fields are kept encoded in raw values, so baselines
+    # never share objects with tables and compare by what was sent
+    lines += ['', 'def _encode_raw(values):', unpack_all] + check
+    encoded_var = ['enc{}({})'.format(i, names[i]) for i in var]
+    lines.append('    return [{}]'.format(', '.join(encoded + encoded_var)))
+
+    for name, values, read in (('_unpack', decoded, 'dec{0}({1})'),
+                               ('_unpack_raw', names, 'bytes({1})')):
+        lines += ['', 'def {}(buff):'.format(name), '    ' + unpack_fixed]
+        items = ['ID'] + values[1:var_slot] + placeholders
+        lines.append('    values = [{}]'.format(', '.join(items)))
+        if len(var):
+            lines.append('    offset = SIZE')
+        for i in var:
+            lines += [
+                '    size, offset = read_varint(buff, offset)',
+                '    end = offset + size',
+                '    values[{}] = {}'.format(
+                    i, read.format(i, 'buff[offset:end]')),
+                '    offset = end',
+            ]
+        lines.append('    return values')
+
+    decoded_var = ['dec{}({})'.format(i, names[i]) for i in var]
+    lines += ['', 'def _decode_raw(raw):']
+    lines.append('    {}, = raw'.format(', '.join(names)))
+    lines.append('    return [{}]'.format(', '.join(decoded + decoded_var)))
+
+    source = '\n'.join(lines) + '\n'
+    exec(compile(source, '<netplay table {}>'.format(tabledef._name), 'exec'),
+         namespace)
+
+    tabledef._source = source
+    for name in ('_pack', '_pack_joined', '_pack_compact', '_encode_raw',
+                 '_unpack', '_unpack_raw', '_decode_raw'):
+        setattr(tabledef, name, namespace[name])
+    tabledef._unpack_compact = namespace.get('_unpack_compact', None)
+
+
 class Table:
-    def __init__(self, tabledef):
-        if type(tabledef) is str:
-            # Fails if the table hasn't been defined
-            tabledef = _TABLES[tabledef]
+    __slots__ = ('_values', 'source')
+    _lazy = False
+
+    def __new__(cls, tabledef):
+        if cls is Table:
+            if type(tabledef) is str:
+                # Fails if the table hasn't been defined
+                tabledef = _TABLES[tabledef]
 
-        self._data = copy.deepcopy(tabledef._datatypes)
-        self._tabledef = tabledef  # For referencing ID and format string
+            cls = tabledef._table_class
+
+        return object.__new__(cls)
+
+    def __init__(self, tabledef):
+        if self._copy_defaults:
+            self._values = copy.deepcopy(self._defaults)
+        else:
+            self._values = list(self._defaults)
 
     def set(self, key, value):
         try:
-            self._data[key][1] = value
+            self._values[self._index[key]] = value
         except KeyError as err:
             msg = 'Did you forget to run TableDef.define?'.format(key)
             err.args = err.args + (msg,)
             raise
 
     def get(self, key):
-        value = self._data.get(key, None)
-        if value is not None:
-            value = value[1]
-        return value
+        i = self._index.get(key, None)
+        if i is None:
+            return None
+        return self._values[i]
 
     def __setitem__(self, key, value):
         self.set(key, value)
@@ -187,8 +1756,86 @@ class Table:
     def __getitem__(self, key):
         return self.get(key)
 
+    def materialize(self):
+        # Tables from to_table(lazy=True) override this
+        return self
+
     def tableName(self):
         return self._tabledef._name
 
     def tableID(self):
         return self._tabledef._id
+
+
+class _LazyTable(Table):
+    """
+    Table view over a received buffer, see to_table.  Fields are decoded
+    on first read and cached in the value list.
+    """
+
+    __slots__ = ('_buff', '_misses')
+    _lazy = True
+
+    def get(self, key):
+        i = self._index.get(key, None)
+        if i is None:
+            return None
+
+        value = self._values[i]
+        if value is _UNDECODED:
+            value = self._decode(i)
+        return value
+
+    def _decode(self, i):
+        tabledef = self._tabledef
+        values = self._values
+
+        self._misses += 1
+        if self._misses > _LAZY_MISSES:
+            self._decode_all()
+            return values[i]
+
+        if i < tabledef._var_slot:
+            st, offset, codec = tabledef._fields[i]
+            value = st.unpack_from(self._buff, offset)[0]
+            if codec is not None:
+                value = codec.decode(value)
+            values[i] = value
+            return value
+
+        # Variable-length fields can only be found by reading them in order
+        decoded = list(values)
+        _read_var(tabledef, decoded, self._buff, tabledef._struct.size,
+                  tabledef._var_slots)
+        for j in tabledef._var_slots:
+            if values[j] is _UNDECODED:
+                values[j] = decoded[j]
+
+        return values[i]
+
+    def _decode_all(self):
+        # One _unpack call, fields that were read or set are kept
+        values = self._values
+        decoded = self._tabledef._unpack(self._buff)
+        for i in range(1, len(values)):
+            if values[i] is _UNDECODED:
+                values[i] = decoded[i]
+
+    def materialize(self):
+        """
+        Decodes whatever hasn't been read yet and returns a regular Table.
+        The buffer is released.
+        """
+        values = self._values
+        for value in values:
+            if value is _UNDECODED:
+                self._decode_all()
+                break
+
+        table = object.__new__(self._tabledef._table_class)
+        table._values = values
+        if hasattr(self, 'source'):
+            table.source = self.source
+
+        self._buff = None
+        return table
@@ -0,0 +1,313 @@
+"""
+Round trips through netplay.packer.  Doesn't need bge:
+
+    python -m pytest -q tests
+    python -m unittest discover tests
+"""
+import math
+import struct
+import unittest
+
+from netplay import packer
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def define_tables():
+    tabledef = packer.TableDef('TestPlain')
+    tabledef.define('uint16', 'id')
+    tabledef.define('float', 'x', 0.0)
+    tabledef.define('int32', 'score', 0)
+    tabledef.define('uint8', 'input', 0)
+    tabledef.define('json', 'name', 'unnamed')
+    tabledef.define('str', 'chat', '')
+
+    tabledef = packer.TableDef('TestNoId')
+    tabledef.define('uint8', 'value', 0)
+
+    tabledef = packer.TableDef('TestTransform')
+    tabledef.define('uint16', 'id')
+    tabledef.define('transform', 'transform', velocity=True)
+
+    tabledef = packer.TableDef('TestBulk')
+    tabledef.define('uint16', 'id')
+    tabledef.define('transform', 'transform')
+    tabledef.define('fixed16', 'health', 100.0, min=0.0, max=100.0)
+    tabledef.define('angle16', 'yaw', 0.0)
+    tabledef.define('double', 'time', 0.0)
+    tabledef.define('vec3', 'aim', (0.0, 0.0, 1.0))
+
+
+define_tables()
+
+
+def make_plain(net_id, **values):
+    table = packer.Table('TestPlain')
+    table['id'] = net_id
+    for key, value in values.items():
+        table[key] = value
+    return table
+
+
+def values_of(table):
+    if table._lazy:
+        table = table.materialize()
+    return dict((key, table.get(key)) for key in table._tabledef._keys[1:])
+
+
+class TestPlain(unittest.TestCase):
+
+    def test_round_trip(self):
+        table = make_plain(7, x=1.5, score=-3, name={'a': [1, 2]},
+                           chat='hi')
+        for lazy in (False, True):
+            result = packer.to_table(packer.to_bytes(table), lazy=lazy)
+            self.assertEqual(result.tableName(), 'TestPlain')
+            self.assertEqual(values_of(result), values_of(table))
+
+    def test_missing_field(self):
+        table = packer.Table('TestPlain')
+        with self.assertRaises(KeyError):
+            packer.to_bytes(table)
+
+    def test_varint(self):
+        for n in (0, 1, 0x7F, 0x80, 0x3FFF, 0x4000, 0xFFFF, 1 << 30):
+            buff = packer._varint(n)
+            self.assertEqual(packer._read_varint(buff, 0), (n, len(buff)))
+
+
+class TestTransform(unittest.TestCase):
+
+    def round_trip(self, value):
+        table = packer.Table('TestTransform')
+        table['id'] = 1
+        table['transform'] = value
+        buff = packer.to_bytes(table)
+        return packer.to_table(buff).get('transform')
+
+    def test_origin_is_exact(self):
+        # Resting objects at the origin mustn't drift
+        zero = (0.0, 0.0, 0.0)
+        pos, rot, lv, av = self.round_trip((zero, (1.0, 0.0, 0.0, 0.0),
+                                            zero, zero))
+        self.assertEqual(pos, zero)
+        self.assertEqual(rot, (1.0, 0.0, 0.0, 0.0))
+        self.assertEqual(lv, zero)
+        self.assertEqual(av, zero)
+
+    def test_within_precision(self):
+        half = math.sqrt(0.5)
+        value = ((12.25, -100.5, 3.0), (half, 0.0, -half, 0.0),
+                 (1.0, -2.0, 3.0), (0.5, 0.0, -0.5))
+        pos, rot, lv, av = self.round_trip(value)
+
+        for a, b in zip(pos, value[0]):
+            self.assertAlmostEqual(a, b, delta=0.01)
+        for a, b in zip(lv + av, value[2] + value[3]):
+            self.assertAlmostEqual(a, b, delta=0.15)
+
+        # q and -q are the same rotation
+        dot = sum(a * b for a, b in zip(rot, value[1]))
+        self.assertAlmostEqual(abs(dot), 1.0, delta=0.001)
+
+    def test_bounds_clamp(self):
+        low, high = packer.WORLD_BOUNDS
+        far = tuple(2 * v for v in high)
+        pos = self.round_trip((far, (1.0, 0.0, 0.0, 0.0),
+                               (0.0,) * 3, (0.0,) * 3))[0]
+        for a, b in zip(pos, high):
+            self.assertAlmostEqual(a, b, delta=0.01)
+
+
+class TestFraming(unittest.TestCase):
+
+    def tables(self):
+        # IDs on both sides of the one and two byte varint limits
+        tables = [make_plain(net_id, x=float(net_id),
+                             chat='x' * (net_id % 200))
+                  for net_id in (0, 5, 127, 128, 300, 16383, 16384, 65535)]
+        table = packer.Table('TestNoId')
+        table['value'] = 9
+        tables.append(table)
+        return tables
+
+    def test_join(self):
+        tables = self.tables()
+        bufflist = [packer.to_bytes(table) for table in tables]
+        joined = packer.join_buffers(bufflist)
+
+        writer = packer.PacketWriter()
+        for table in tables:
+            writer.write_table(table)
+        self.assertEqual(bytes(writer.finish()), joined)
+
+        result = [bytes(buff) for buff in packer.unjoin_buffers(joined)]
+        self.assertEqual(result, bufflist)
+
+    def test_compact(self):
+        tables = self.tables()
+        writer = packer.PacketWriter(compact=True)
+        for table in tables:
+            writer.write_table(table)
+        # Already packed buffers go through the same framing
+        writer.write(packer.to_bytes(tables[3]))
+        buff = bytes(writer.finish())
+
+        self.assertTrue(packer.is_compact(buff))
+        self.assertLess(len(buff), len(packer.join_buffers(
+            [packer.to_bytes(table) for table in tables + tables[3:4]])))
+
+        expected = [values_of(table) for table in tables + tables[3:4]]
+        for lazy in (False, True):
+            frames = packer.unjoin_buffers(buff)
+            names = [packer.get_tabledef(frame).tableName()
+                     for frame in frames]
+            self.assertEqual(names, ['TestPlain'] * 8 + ['TestNoId',
+                                                         'TestPlain'])
+            result = [values_of(packer.to_table(frame, lazy=lazy))
+                      for frame in frames]
+            self.assertEqual(result, expected)
+
+    def test_compact_id_range(self):
+        writer = packer.PacketWriter(compact=True)
+        with self.assertRaises(struct.error):
+            writer.write_table(make_plain(-1))
+        with self.assertRaises(struct.error):
+            writer.write_table(make_plain(0x10000))
+
+    def test_compressed(self):
+        compressor = packer.PacketCompressor(threshold=0)
+        buff = packer.join_buffers([packer.to_bytes(make_plain(i))
+                                    for i in range(20)])
+        packed = compressor.compress(buff)
+        self.assertLess(len(packed), len(buff))
+        self.assertEqual(bytes(compressor.decompress(packed)), buff)
+
+        small = packer.PacketCompressor(threshold=0, max_size=len(buff) - 1)
+        self.assertIsNone(small.decompress(packed))
+
+
+class TestDelta(unittest.TestCase):
+
+    def test_round_trip(self):
+        sent = {}
+        received = {}
+        table = make_plain(3, x=1.0, name=['a'])
+
+        keyframe = packer.to_delta_bytes(table, sent)
+        result = packer.to_table(keyframe, received)
+        self.assertEqual(values_of(result), values_of(table))
+
+        self.assertIsNone(packer.to_delta_bytes(table, sent))
+
+        table['x'] = 2.0
+        delta = packer.to_delta_bytes(table, sent)
+        self.assertLess(len(delta), len(keyframe))
+        result = packer.to_table(delta, received)
+        self.assertEqual(values_of(result), values_of(table))
+
+        # Changed variable-length fields come along too
+        table['name'] = ['a', 'b']
+        result = packer.to_table(packer.to_delta_bytes(table, sent),
+                                 received)
+        self.assertEqual(result.get('name'), ['a', 'b'])
+
+    def test_needs_baselines(self):
+        table = make_plain(4)
+        keyframe = packer.to_delta_bytes(table, {})
+        with self.assertRaises(ValueError):
+            packer.to_table(keyframe)
+
+    def test_compact(self):
+        sent = {}
+        received = {}
+        table = make_plain(200, x=1.0)
+        writer = packer.PacketWriter(compact=True)
+        writer.write(packer.to_delta_bytes(table, sent))
+        table['score'] = 10
+        writer.write(packer.to_delta_bytes(table, sent))
+
+        frames = packer.unjoin_buffers(bytes(writer.finish()))
+        results = [packer.to_table(frame, received) for frame in frames]
+        self.assertEqual(results[1].get('score'), 10)
+        self.assertEqual(values_of(results[1]), values_of(table))
+
+
+class TestSparse(unittest.TestCase):
+
+    def test_defaults_left_out(self):
+        table = make_plain(5, score=12)
+        buff = packer.to_bytes(table, sparse=True)
+        self.assertLess(len(buff), len(packer.to_bytes(table)))
+        self.assertEqual(values_of(packer.to_table(buff)), values_of(table))
+
+    def test_full_table(self):
+        # Nothing to leave out, sent as a regular table
+        table = make_plain(6, x=1.0, score=2, input=3, name='n', chat='c')
+        self.assertEqual(packer.to_bytes(table, sparse=True),
+                         packer.to_bytes(table))
+
+    def test_writer(self):
+        table = make_plain(7, input=1)
+        for compact in (False, True):
+            writer = packer.PacketWriter(compact=compact)
+            writer.write_table(table, sparse=True)
+            frames = packer.unjoin_buffers(bytes(writer.finish()))
+            self.assertEqual(values_of(packer.to_table(frames[0])),
+                             values_of(table))
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class TestEncodeMany(unittest.TestCase):
+
+    def rows(self):
+        tabledef = packer._TABLES['TestBulk']
+        array = numpy.zeros(5, tabledef.to_dtype())
+        array['id'] = numpy.arange(5) + 120
+        array['transform']['pos'] = [(i, -i, 0.5 * i) for i in range(5)]
+        array['transform']['rot'] = (1.0, 0.0, 0.0, 0.0)
+        array['transform']['rot'][2] = (0.0, 0.0, 1.0, 0.0)
+        array['health'] = numpy.linspace(0.0, 100.0, 5)
+        array['yaw'] = numpy.linspace(-3.0, 3.0, 5)
+        array['time'] = numpy.arange(5) * 0.25
+        array['aim'] = (0.0, 1.0, 0.0)
+        return tabledef, array
+
+    def test_matches_to_bytes(self):
+        tabledef, array = self.rows()
+        bufflist = []
+        for row in array:
+            table = packer.Table('TestBulk')
+            table['id'] = int(row['id'])
+            pos = tuple(float(v) for v in row['transform']['pos'])
+            rot = tuple(float(v) for v in row['transform']['rot'])
+            table['transform'] = (pos, rot)
+            for key in ('health', 'yaw', 'time'):
+                table[key] = float(row[key])
+            table['aim'] = tuple(float(v) for v in row['aim'])
+            bufflist.append(packer.to_bytes(table))
+
+        self.assertEqual(tabledef.encode_many(array),
+                         packer.join_buffers(bufflist))
+
+    def test_round_trip(self):
+        tabledef, array = self.rows()
+        result = tabledef.decode_many(tabledef.encode_many(array))
+        self.assertTrue(numpy.array_equal(result['id'], array['id']))
+        self.assertTrue(numpy.allclose(result['health'], array['health'],
+                                       atol=0.01))
+        self.assertTrue(numpy.allclose(result['transform']['pos'],
+                                       array['transform']['pos'],
+                                       atol=0.01))
+
+    def test_variable_length(self):
+        with self.assertRaises(TypeError):
+            packer._TABLES['TestPlain'].encode_many(
+                numpy.zeros(1, [('id', 'u2')]))
+
+
+if __name__ == '__main__':
+    unittest.main()